@@ -0,0 +1,358 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Helpers for talking to a device over adb.
+
+The adb executable can be overridden with the ADB environment variable, e.g. to
+point at a fake adb script when developing without a device attached.
+"""
+
+import os
+import queue
+import shlex
+import subprocess
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+ADB_EXECUTABLE = os.environ.get('ADB', 'adb')
+
+DEFAULT_COMMAND_TIMEOUT_SECONDS = 120
+DEFAULT_POLL_INTERVAL_SECONDS = 0.1
+
+# How long AdbShell.start waits for the shell to echo its probe.
+SHELL_START_TIMEOUT_SECONDS = 30
+
+# returncode is None if the command timed out.
+CommandTiming = namedtuple('CommandTiming', ['args', 'returncode', 'seconds'])
+
+
+def get_adb_args(serial=None):
+    args = [ADB_EXECUTABLE]
+    if serial:
+        args += ['-s', serial]
+    return args
+
+
+def get_connected_device_serials():
+    """Returns the serials of the devices listed by `adb devices` that are ready to use."""
+    proc = subprocess.run(get_adb_args() + ['devices'], check=True, capture_output=True, text=True)
+    # Sample output:
+    # List of devices attached
+    # ZY2243N2N6	device
+    # emulator-5554	offline
+    serials = []
+    for line in proc.stdout.splitlines()[1:]:
+        columns = line.split()
+        if len(columns) >= 2 and columns[1] == 'device':
+            serials.append(columns[0])
+    return serials
+
+
+def get_device_model(serial=None):
+    proc = subprocess.run(get_adb_args(serial) + ['shell', 'getprop', 'ro.product.model'], check=True,
+                          capture_output=True, text=True)
+    return proc.stdout.strip()
+
+
+def poll_until(condition, timeout_seconds, interval_seconds=DEFAULT_POLL_INTERVAL_SECONDS):
+    """Calls condition until it returns True or timeout_seconds elapse. Returns whether the condition held.
+
+    This should be preferred over fixed sleeps, which are either too long, wasting time, or too short,
+    leaving the device in an unexpected state.
+    """
+    deadline = time.monotonic() + timeout_seconds
+    while True:
+        if condition():
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval_seconds)
+
+
+def is_process_running(process_name, shell=None, serial=None):
+    """Returns whether a process with exactly the given name is running. Uses the shell, if given, to avoid
+    spawning adb.
+    """
+    args = ['pidof', process_name]
+    if shell:
+        return shell.run(args).returncode == 0
+    return subprocess.run(get_adb_args(serial) + ['shell'] + args, capture_output=True).returncode == 0
+
+
+def get_pid(process_name, shell=None, serial=None):
+    """Returns the pid of the process with exactly the given name or None if it isn't running. Uses the shell, if
+    given, to avoid spawning adb.
+    """
+    args = ['pidof', process_name]
+    if shell:
+        proc = shell.run(args)
+    else:
+        proc = subprocess.run(get_adb_args(serial) + ['shell'] + args, capture_output=True)
+    pids = proc.stdout.split()
+    return int(pids[0]) if proc.returncode == 0 and pids and pids[0].isdigit() else None
+
+
+def get_running_process_names(serial=None):
+    proc = subprocess.run(get_adb_args(serial) + ['shell', 'ps', '-A', '-o', 'NAME'], check=True,
+                          capture_output=True, text=True)
+    return [line.strip() for line in proc.stdout.splitlines()[1:]]  # The first line is the header.
+
+
+def wait_for_processes_to_exit(name_substring, timeout_seconds, serial=None):
+    """Waits until no running process name contains name_substring. Returns False on timeout."""
+    return poll_until(lambda: not any(name_substring in name for name in get_running_process_names(serial)),
+                      timeout_seconds)
+
+
+class _LineReader:
+    """Reads lines from a pipe on a background thread so callers can wait on them with a timeout.
+    None is queued when the pipe is closed.
+    """
+
+    def __init__(self, pipe):
+        self._lines = queue.Queue()
+        self._thread = threading.Thread(target=self._read, args=(pipe,), daemon=True)
+        self._thread.start()
+
+    def _read(self, pipe):
+        for line in iter(pipe.readline, b''):
+            self._lines.put(line)
+        self._lines.put(None)
+
+    def readline(self, timeout):
+        """Returns the next line, None on EOF, or raises queue.Empty on timeout."""
+        return self._lines.get(timeout=timeout)
+
+
+class AdbShell:
+    """A long-lived `adb shell` session that many commands can be sent through.
+
+    Spawning `adb` for each command costs a new handshake with the adb server and device,
+    which adds latency and jitter to the measurements. Instead, we keep one shell open and
+    write commands to its stdin, delimiting the output of each command with a marker unique
+    to that command so the late output of a command that timed out isn't mistaken for the
+    output of the next one.
+
+    Each command's duration is recorded in `timings` so the harness overhead can be inspected. If a command times
+    out, the shell is restarted so the command can't delay, and be counted against, the next one.
+
+    Without the shell protocol v2, e.g. on older devices, adb merges stderr into stdout so the output can't be
+    delimited: each command is then run with its own `adb shell`, like before this class existed.
+
+    Usage:
+        with AdbShell() as shell:
+            proc = shell.run(['am', 'force-stop', 'org.mozilla.fenix'], check=True)
+    """
+
+    def __init__(self, serial=None):
+        self.serial = serial
+        self.timings = []
+        self._proc = None
+        self._stdout = None
+        self._stderr = None
+        self._is_started = False
+        self._merges_stderr = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        self._start_proc()
+        self._is_started = True
+        self._merges_stderr = self._is_stderr_merged()
+        if self._merges_stderr:
+            self._kill_proc()
+
+    def _start_proc(self):
+        self._proc = subprocess.Popen(get_adb_args(self.serial) + ['shell'], stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._stdout = _LineReader(self._proc.stdout)
+        self._stderr = _LineReader(self._proc.stderr)
+
+    def _is_stderr_merged(self):
+        """Echoes a marker to stderr and then another to stdout: if the stderr marker comes first on stdout, the
+        streams are merged.
+        """
+        stderr_marker = '__PERF_TOOLS_{}__'.format(uuid.uuid4().hex)
+        stdout_marker = '__PERF_TOOLS_{}__'.format(uuid.uuid4().hex)
+        self._proc.stdin.write('echo "{}" >&2; echo "{}"\n'.format(stderr_marker, stdout_marker).encode('utf-8'))
+        self._proc.stdin.flush()
+        is_merged = False
+        deadline = time.monotonic() + SHELL_START_TIMEOUT_SECONDS
+        while True:
+            try:
+                line = self._stdout.readline(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                raise RuntimeError('adb shell did not respond within {}s'.format(SHELL_START_TIMEOUT_SECONDS))
+            if line is None:
+                raise RuntimeError('adb shell exited unexpectedly on start')
+            if stdout_marker.encode('utf-8') in line:
+                break
+            is_merged = is_merged or stderr_marker.encode('utf-8') in line
+        # If the streams are separate, the stderr marker is skipped by the next command's read of stderr, which
+        # starts at its own marker.
+        return is_merged
+
+    def _kill_proc(self):
+        self._proc.kill()
+        self._proc.wait()
+        self._proc = None
+
+    def close(self):
+        self._is_started = False
+        if not self._proc:
+            return
+        try:
+            self._proc.stdin.write(b'exit\n')
+            self._proc.stdin.close()
+            self._proc.wait(timeout=5)
+        except (BrokenPipeError, subprocess.TimeoutExpired):
+            self._kill_proc()
+        self._proc = None
+
+    def run(self, args, check=False, timeout=DEFAULT_COMMAND_TIMEOUT_SECONDS):
+        """Runs the given command on the device and waits for it to complete.
+
+        The return value mimics subprocess.run(..., capture_output=True) so this can be used as a
+        drop-in replacement: stdout and stderr are bytes.
+        """
+        if not self._is_started:
+            raise RuntimeError('AdbShell.run called before start()')
+        if self._proc and self._proc.poll() is not None:
+            raise RuntimeError('adb shell exited unexpectedly before running: {}'.format(args))
+
+        command_str = ' '.join(shlex.quote(arg) for arg in args)
+        marker = '__PERF_TOOLS_{}__'.format(uuid.uuid4().hex)
+        start = time.monotonic()
+        try:
+            if self._merges_stderr:
+                stdout, stderr, returncode = self._run_in_new_shell(command_str, marker, timeout, args)
+            else:
+                stdout, stderr, returncode = self._run_in_shell(command_str, marker, start, timeout, args)
+        except subprocess.TimeoutExpired:
+            self.timings.append(CommandTiming(args, None, time.monotonic() - start))
+            if self._proc:
+                # The command may still be running: its output would delay the next command's.
+                self._kill_proc()
+                self._start_proc()
+            raise
+        self.timings.append(CommandTiming(args, returncode, time.monotonic() - start))
+
+        proc = subprocess.CompletedProcess(args, returncode, stdout, stderr)
+        if check:
+            proc.check_returncode()
+        return proc
+
+    def _run_in_shell(self, command_str, marker, start, timeout, args):
+        # We echo the marker to both streams before and after the command so we know where its
+        # output starts and ends on each. The exit code is attached to the last stdout marker.
+        # stdin is redirected so the command can't consume the commands we write after it.
+        self._proc.stdin.write(('echo "{marker}"; echo "{marker}" >&2; {cmd} </dev/null; echo "{marker} $?"; '
+                                'echo "{marker}" >&2\n'.format(cmd=command_str, marker=marker)).encode('utf-8'))
+        self._proc.stdin.flush()
+        stdout, returncode = self._read_between_markers(self._stdout, marker, start, timeout, args)
+        stderr, _ = self._read_between_markers(self._stderr, marker, start, timeout, args)
+        return stdout, stderr, returncode
+
+    def _run_in_new_shell(self, command_str, marker, timeout, args):
+        # Without the shell protocol v2, adb doesn't return the command's exit code so we echo it after a marker.
+        # stderr is part of stdout.
+        proc = subprocess.run(get_adb_args(self.serial) + ['shell', '{}; echo "{} $?"'.format(command_str, marker)],
+                              capture_output=True, timeout=timeout)
+        stdout, separator, status = proc.stdout.rpartition(marker.encode('utf-8'))
+        if not separator:
+            raise RuntimeError('adb shell did not report the exit code of: {}'.format(args))
+        return stdout, proc.stderr, int(status.strip())
+
+    def _read_between_markers(self, reader, marker, start, timeout, args):
+        """Skips the output before the first marker, e.g. from an earlier command that timed out, and returns
+        the output up to the second marker and the status after it.
+        """
+        marker = marker.encode('utf-8')
+        is_started = False
+        output = b''
+        while True:
+            remaining = timeout - (time.monotonic() - start)
+            try:
+                line = reader.readline(timeout=max(remaining, 0))
+            except queue.Empty:
+                raise subprocess.TimeoutExpired(args, timeout, output=output)
+            if line is None:
+                raise RuntimeError('adb shell exited unexpectedly while running: {}'.format(args))
+
+            # The command may not end its output with a newline so the marker can be mid-line.
+            marker_index = line.find(marker)
+            if not is_started:
+                is_started = marker_index >= 0
+                continue
+            if marker_index < 0:
+                output += line
+                continue
+
+            output += line[:marker_index]
+            status = line[marker_index + len(marker):].strip()
+            return output, int(status) if status else None
+
+    def print_timings(self, stream=None):
+        """Prints the per-command duration breakdown, grouped by the command's first arguments."""
+        command_to_durations = {}
+        for timing in self.timings:
+            command = ' '.join(timing.args[:2])
+            command_to_durations.setdefault(command, []).append(timing.seconds)
+
+        print('adb shell command timings (count, total s, mean ms, max ms):', file=stream)
+        for command, durations in sorted(command_to_durations.items(), key=lambda e: -sum(e[1])):
+            print('  {:<32} {:>4} {:>8.2f} {:>8.1f} {:>8.1f}'.format(
+                command, len(durations), sum(durations), sum(durations) / len(durations) * 1000,
+                max(durations) * 1000), file=stream)
+
+
+class LogcatTail:
+    """Streams `adb logcat` so callers can react to lines as soon as they are logged.
+
+    `adb logcat` first prints the existing buffer and then follows new output so, if the buffer
+    was cleared beforehand, lines logged before this is started are still seen.
+
+    Usage:
+        with LogcatTail() as logcat:
+            line = logcat.readline(timeout=5)
+    """
+
+    def __init__(self, serial=None):
+        self.serial = serial
+        self._proc = None
+        self._reader = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        self._proc = subprocess.Popen(get_adb_args(self.serial) + ['logcat'], stdout=subprocess.PIPE,
+                                      stderr=subprocess.DEVNULL)
+        self._reader = _LineReader(self._proc.stdout)
+
+    def close(self):
+        if not self._proc:
+            return
+        self._proc.terminate()
+        try:
+            self._proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+            self._proc.wait()
+        self._proc = None
+
+    def readline(self, timeout):
+        """Returns the next line as bytes, None if logcat exited, or raises queue.Empty on timeout."""
+        return self._reader.readline(timeout=timeout)
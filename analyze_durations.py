@@ -5,30 +5,87 @@
 
 import argparse
 import ast
+import functools
+import hashlib
+import io
 import json
+import mmap
 import os
 import re
 import statistics as stat
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from enum import Enum, auto
 from pprint import pprint
 
+import numpy as np
+
+import fileutil
+import perfmath
+
 DESC = """Provides statistics relevant to performance analysis on the given duration
 measurements such as the mean, median, and max values. Sample output:
 
-{'max': 2415.0,
+{'cv': 0.0396,
+ 'iqr': 71.5,
+ 'mad': 22.0,
+ 'max': 2415.0,
  'mean': 2187.92,
  'median': 2141.0,
  'min': 2101.0,
+ 'p5': 2104.45,
+ 'p25': 2125.25,
+ 'p75': 2196.75,
+ 'p90': 2341.2,
+ 'p95': 2380.6,
+ 'p99': 2409.12,
  'replicate_count': 50,
- 'replicates': [2116.0, 2212.0, 2145.0, ..., 2391.0, 2195.0]}
+ 'replicates': [2116.0, 2212.0, 2145.0, ..., 2391.0, 2195.0],
+ 'stdev': 86.6,
+ 'trimmed_mean': 2166.35}
 
 See the `path` argument for supported file formats.
 """
 
 LOGCAT_MATCH_STR = 'average '
+LOGCAT_MATCH_BYTES = LOGCAT_MATCH_STR.encode('utf-8')
 LOGCAT_EXPECTED_FORMAT = '2020-05-04 15:15:50.340 10845-10845/? E/lol: average 37'
 
+# The file type is detected from this many bytes at the start of the file (and its first line, for JSON).
+FILETYPE_SNIFF_SIZE = 4096
+
+# measure_start_up.py writes one JSON object per iteration, on its own line, with the duration under this key.
+MEASUREMENT_RECORD_KEY_DURATION = 'duration'
+MEASUREMENT_RECORD_KEY_THERMAL = 'thermal'
+MEASUREMENT_RECORD_KEY_IS_THROTTLED = 'is_throttled'
+
+# The output of this script is a JSON object with the replicates under this key.
+STATS_KEY_REPLICATES = 'replicates'
+
+KEY_THROTTLED_REPLICATE_INDICES = 'throttled_replicate_indices'
+KEY_MEDIAN_BOOTSTRAP_CI = 'median_bootstrap_ci'
+KEY_REJECTED_REPLICATES = 'rejected_replicates'
+
+COMPARISON_VERDICT_REGRESSION = 'regression'
+COMPARISON_VERDICT_IMPROVEMENT = 'improvement'
+COMPARISON_VERDICT_NO_CHANGE = 'no change'
+
+DEFAULT_STREAM_UPDATE_INTERVAL = 10
+FOLLOW_POLL_INTERVAL_SECONDS = 0.5
+STDIN_PATH = '-'
+
+OUTLIER_METHOD_MAD = 'mad'
+OUTLIER_METHOD_IQR = 'iqr'
+OUTLIER_METHODS = [OUTLIER_METHOD_MAD, OUTLIER_METHOD_IQR]
+REJECTED_REASON_WARM_UP = 'warm_up'
+
+ANALYSIS_CACHE_DIR = os.path.join(fileutil.CACHE_DIR, 'analyze_durations')
+
+# Increment this when the parsing or the stats change so stale cache entries are recomputed.
+ANALYSIS_CACHE_VERSION = 1
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description=DESC, formatter_class=argparse.RawTextHelpFormatter)
@@ -37,9 +94,11 @@ def parse_args():
 - durations separated by newlines
 - perfherder-data-json output from mozperftest VIEW
 - logcat where some lines have a logged value of 'average <duration>'
-- the output of this script""")
+- measurement records from measure_start_up.py: one JSON object per line
+- the output of this script: JSON or, from older versions, a Python dict literal""")
 
     parser.add_argument("-o", "--output-safe", help="""writes the output to the given path, in addition to printing.
+The output is written as JSON.
 This operation is safe (non-destructive): if the path already exists, the script will abort.
 This is useful to avoid accidentally deleting results.""")
 
@@ -47,6 +106,38 @@ This is useful to avoid accidentally deleting results.""")
                         help=("displays a graph of the replicates, in addition to printing the output. Requires "
                               "matplotlib (from the venv requirements)"))
 
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="the number of processes used to analyze multiple paths in parallel. defaults to 1")
+    parser.add_argument("--no-cache", action="store_true",
+                        help=("don't read or write the analysis cache. By default, the replicates and stats of each "
+                              "file are cached in {} keyed by the hash of its contents so unchanged files aren't "
+                              "analyzed again").format(ANALYSIS_CACHE_DIR))
+
+    parser.add_argument("--reject-outliers", choices=OUTLIER_METHODS,
+                        help=("removes the outliers from the replicates before computing the stats: either the values "
+                              "with a modified z-score, from the median absolute deviation, above {} (mad) or the "
+                              "values outside of Tukey's fences (iqr). The rejected replicates are listed under "
+                              "'{}'").format(perfmath.MAD_OUTLIER_THRESHOLD, KEY_REJECTED_REPLICATES))
+    parser.add_argument("--trim-warm-up", action="store_true",
+                        help=("removes the initial transient, e.g. slow first runs after an install, from the "
+                              "replicates before computing the stats. It's detected with the Marginal Standard Error "
+                              "Rule (MSER). The rejected replicates are listed under '{}'").format(
+                                  KEY_REJECTED_REPLICATES))
+
+    parser.add_argument("--stream", action="store_true",
+                        help=("reads a logcat incrementally and prints running stats, estimated in bounded memory, "
+                              "every --update-interval measurements and at the end. Use a path of {} to read "
+                              "stdin, e.g. `adb logcat | ./analyze_durations.py --stream -`").format(STDIN_PATH))
+    parser.add_argument("--follow", action="store_true",
+                        help="with --stream, waits for more lines at the end of the file, like `tail -f`, until ^C")
+    parser.add_argument("--update-interval", type=int, default=DEFAULT_STREAM_UPDATE_INTERVAL,
+                        help="with --stream, the number of measurements between updates. defaults to {}".format(
+                            DEFAULT_STREAM_UPDATE_INTERVAL))
+
+    parser.add_argument("--bootstrap-ci", action="store_true",
+                        help=("adds the bootstrapped 95%% confidence interval of the median to the output. "
+                              "The seed is fixed so the interval is reproducible"))
+
     parser.add_argument(
         "--print-github-table-header", action="store_true",
         help=("prints the input-agnostic header for --print-github-table-row args and exits. "
@@ -55,6 +146,15 @@ This is useful to avoid accidentally deleting results.""")
     parser.add_argument(
         "--print-github-table-row", action="store_true", help="prints the result formatted as a GitHub table row"
     )
+    parser.add_argument("--labels", type=lambda labels: labels.split(','),
+                        help=("comma-separated names of the paths, in the same order, for GitHub tables, e.g. "
+                              "main,patch. defaults to the file names"))
+
+    parser.add_argument("--compare", action="store_true",
+                        help=("compares each path against the first, the baseline, and prints a GitHub table with "
+                              "the percent change of the medians, its bootstrapped 95%% confidence interval, and the "
+                              "Mann-Whitney U test's p-value. A change is only reported as a regression or an "
+                              "improvement if its confidence interval excludes 0"))
     return parser.parse_args()
 
 
@@ -68,67 +168,242 @@ def validate_args(args):
     if args.graph and len(args.path) > 1:
         print("--graph cannot be combined with multiple path arguments.", file=sys.stderr)
         sys.exit(1)
+    if args.jobs < 1:
+        print("--jobs must be at least 1.", file=sys.stderr)
+        sys.exit(1)
+    if args.stream and len(args.path) > 1:
+        print("--stream cannot be combined with multiple path arguments.", file=sys.stderr)
+        sys.exit(1)
+    if args.stream and (args.output_safe or args.graph or args.print_github_table_row or args.bootstrap_ci or
+                        args.reject_outliers or args.trim_warm_up):
+        print("--stream only supports printing the stats: it doesn't keep the replicates.", file=sys.stderr)
+        sys.exit(1)
+    if args.compare and len(args.path) < 2:
+        print("--compare requires a baseline path and at least one path to compare to it.", file=sys.stderr)
+        sys.exit(1)
+    if args.compare and (args.output_safe or args.graph or args.print_github_table_row or args.stream):
+        print("--compare only supports printing the comparison table.", file=sys.stderr)
+        sys.exit(1)
+    if args.labels and len(args.labels) != len(args.path):
+        print("--labels must have one label per path.", file=sys.stderr)
+        sys.exit(1)
+    if args.follow and not args.stream:
+        print("--follow requires --stream.", file=sys.stderr)
+        sys.exit(1)
+    if args.update_interval < 1:
+        print("--update-interval must be at least 1.", file=sys.stderr)
+        sys.exit(1)
+
+
+def load_json_object(line):
+    """Returns the JSON object in the given line, or None if it doesn't contain one."""
+    if not line.startswith(b'{"'):
+        return None
+    try:
+        obj = json.loads(line)
+    except json.JSONDecodeError:
+        return None
+    return obj if isinstance(obj, dict) else None
+
+
+@contextmanager
+def map_file(path):
+    """Memory maps the given file, read-only, so it can be scanned like bytes without reading it all into memory.
+    Only the pages that are accessed are read from disk.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''  # Empty files can't be mapped.
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+            yield contents
 
 
 def detect_filetype(path):
-    with open(path) as f:
-        contents = f.read()
+    with map_file(path) as contents:
+        return detect_filetype_from_bytes(contents)
+
 
-    if contents.startswith('{"suites":'):
+def get_first_line(contents):
+    line_end = contents.find(b'\n')
+    return contents[:line_end if line_end >= 0 else len(contents)]
+
+
+def detect_filetype_from_bytes(contents):
+    """Detects the file type from the start of the given bytes or memory map so the rest needn't be read."""
+    head = contents[:FILETYPE_SNIFF_SIZE]
+    if head.startswith(b'{"suites":'):
         return InputFileType.PERFHERDER_JSON
-    elif contents.startswith("{'"):
+    elif head.startswith(b"{'"):
+        return InputFileType.SCRIPT_OUTPUT  # The legacy output format: a Python dict literal.
+
+    first_object = load_json_object(get_first_line(contents)) if head.startswith(b'{"') else None
+    if first_object and STATS_KEY_REPLICATES in first_object:
         return InputFileType.SCRIPT_OUTPUT
-    elif re.match(r'^\d+-\d+', contents):
+    elif first_object and MEASUREMENT_RECORD_KEY_DURATION in first_object:
+        return InputFileType.MEASUREMENT_RECORDS
+    elif re.match(rb'^\d+-\d+', head):
         return InputFileType.LOGCAT
     else:
         return InputFileType.NEWLINES
 
 
-def read_from_file_separated_by_newlines(path):
-    with open(path) as f:
-        contents = f.read()
-    return [float(r) for r in contents.split('\n') if r]  # trailing if is used to remove empty lines.
+def iter_content_lines(contents):
+    """Yields each line of the given bytes or memory map, one at a time, so the whole contents aren't copied."""
+    reader = io.BytesIO(contents) if isinstance(contents, bytes) else contents
+    reader.seek(0)
+    return iter(reader.readline, b'')
+
+
+def parse_file_separated_by_newlines(contents):
+    # trailing if is used to remove empty lines.
+    return [float(r) for r in iter_content_lines(contents) if r.strip()]
 
 
-def read_from_perfherder_json(path):
-    with open(path) as f:
-        contents = json.load(f)
+def parse_perfherder_json(contents):
+    contents = json.loads(contents[:])
 
     # Hard-coded to paths for perftest VIEW.
     return [float(e) for e in contents['suites'][0]['subtests'][0]['replicates']]
 
 
-def read_from_output(path):
-    with open(path) as f:
-        contents = ast.literal_eval(f.read())
-    return contents['replicates']
+def iter_measurement_records(lines):
+    """Yields each record of a measurement records file given an iterable of its lines, as str or bytes."""
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
 
 
-def read_from_logcat_file(path):
-    measurements = []
-    with open(path) as f:
-        for line in f:
-            # The message will be after the last colon because we demand a certain formatting.
-            message_text = line[line.rfind(': ') + 2:]  # +2 to move past ': '.
+def parse_measurement_records_and_throttling(contents):
+    """Returns the durations of the measurement records and the indices, into the durations, of the measurements
+    that started while the device was throttled, from a single pass over the records.
+    """
+    durations = []
+    throttled_indices = []
+    for index, record in enumerate(iter_measurement_records(iter_content_lines(contents))):
+        durations.append(float(record[MEASUREMENT_RECORD_KEY_DURATION]))
+        if (record.get(MEASUREMENT_RECORD_KEY_THERMAL) or {}).get(MEASUREMENT_RECORD_KEY_IS_THROTTLED):
+            throttled_indices.append(index)
+    return durations, throttled_indices
+
+
+def parse_measurement_records(contents):
+    return parse_measurement_records_and_throttling(contents)[0]
+
+
+def flag_throttled_replicates(stats, throttled_indices, kept_indices=None):
+    """Adds the indices of the throttled replicates, if any, to the stats so the affected samples can be identified.
+    If some replicates were rejected, kept_indices are the indices of the remaining ones in the input.
+    """
+    if kept_indices is not None:
+        input_index_to_replicate_index = {input_index: index for index, input_index in enumerate(kept_indices)}
+        throttled_indices = [input_index_to_replicate_index[i] for i in throttled_indices
+                             if i in input_index_to_replicate_index]
+    if throttled_indices:
+        stats[KEY_THROTTLED_REPLICATE_INDICES] = throttled_indices
+
+
+def parse_stats(contents):
+    """Parses the output of this script. Older versions wrote a Python dict literal, which is much slower to parse,
+    rather than JSON.
+    """
+    if contents[:2] == b"{'":
+        return ast.literal_eval(contents[:].decode('utf-8'))
+    return json.loads(contents[:])
+
+
+def load_stats(path):
+    """Loads the stats written by save_output, e.g. by backfill.py."""
+    with map_file(path) as contents:
+        return parse_stats(contents)
 
-            if message_text and message_text.startswith(LOGCAT_MATCH_STR):
-                measurements.append(float(message_text[len(LOGCAT_MATCH_STR):]))
+
+def parse_output(contents):
+    return parse_stats(contents)[STATS_KEY_REPLICATES]
+
+
+def parse_logcat_line(line):
+    """Returns the value of the 'average <n>' message in the given logcat line, as bytes, or None if it has none."""
+    # The message will be after the last colon because we demand a certain formatting.
+    message_text = line[line.rfind(b': ') + 2:]  # +2 to move past ': '.
+    if message_text.startswith(LOGCAT_MATCH_BYTES):
+        return float(message_text[len(LOGCAT_MATCH_BYTES):])
+    return None
+
+
+def parse_logcat(contents):
+    """Returns the values of the 'average <n>' messages in the given logcat bytes or memory map.
+
+    We search for the message with bytes.find, which is much faster than splitting the logcat into lines, and
+    only slice out the matching lines so a memory mapped logcat is never read into memory as a whole.
+    """
+    needle = b': ' + LOGCAT_MATCH_BYTES
+    measurements = []
+    index = contents.find(needle)
+    while index >= 0:
+        line_start = contents.rfind(b'\n', 0, index) + 1
+        line_end = contents.find(b'\n', index)
+        if line_end < 0:
+            line_end = len(contents)
+
+        value = parse_logcat_line(contents[line_start:line_end])
+        if value is not None:
+            measurements.append(value)
+        index = contents.find(needle, line_end)
 
     if len(measurements) == 0:
         print('WARN: no lines matched. expected format like:\n    {}'.format(LOGCAT_EXPECTED_FORMAT))
     return measurements
 
 
+# The percentiles included in the stats, e.g. 'p90'.
+STATS_PERCENTILES = [5, 25, 75, 90, 95, 99]
+
+# The proportion of values removed from each end before computing the trimmed mean.
+TRIMMED_MEAN_PROPORTION = 0.1
+
+
+def percentiles_of_sorted(sorted_values, percentiles):
+    """Returns the given percentiles of an already sorted array, linearly interpolating between values like
+    numpy.percentile's default, without sorting again.
+    """
+    positions = (len(sorted_values) - 1) * np.asarray(percentiles, dtype=float) / 100
+    lower = np.floor(positions).astype(int)
+    upper = np.ceil(positions).astype(int)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (positions - lower)
+
+
 def to_stats(measurements_arr):
-    return {
-        'max': max(measurements_arr),
-        'mean': stat.mean(measurements_arr),
-        'median': stat.median(measurements_arr),
-        'min': min(measurements_arr),
-        'replicate_count': len(measurements_arr),
+    if len(measurements_arr) < 2:
+        raise stat.StatisticsError('at least two measurements are required to compute the stats')
+
+    # We sort once and derive the order statistics (min, max, median, percentiles) from the sorted array. The median
+    # absolute deviation needs its own sort of the deviations, which np.median would otherwise do on a copy.
+    values = np.asarray(measurements_arr, dtype=float)
+    sorted_values = np.sort(values)
+    count = len(sorted_values)
+
+    median, *percentiles = percentiles_of_sorted(sorted_values, [50] + STATS_PERCENTILES)
+    mean = values.mean()
+    stdev = values.std(ddof=1)  # The sample standard deviation, like statistics.stdev.
+    trim_count = int(count * TRIMMED_MEAN_PROPORTION)
+
+    stats = {
+        'max': float(sorted_values[-1]),
+        'mean': float(mean),
+        'median': float(median),
+        'min': float(sorted_values[0]),
+        'replicate_count': count,
         'replicates': measurements_arr,
-        'stdev': stat.stdev(measurements_arr),
+        'stdev': float(stdev),
+        'iqr': float(percentiles[STATS_PERCENTILES.index(75)] - percentiles[STATS_PERCENTILES.index(25)]),
+        'mad': float(percentiles_of_sorted(np.sort(np.abs(values - median)), [50])[0]),
+        'trimmed_mean': float(sorted_values[trim_count:count - trim_count].mean()),
+        'cv': float(stdev / mean),  # The coefficient of variation.
     }
+    for percentile, value in zip(STATS_PERCENTILES, percentiles):
+        stats['p{}'.format(percentile)] = float(value)
+    return stats
 
 
 def print_github_table_header():
@@ -136,8 +411,47 @@ def print_github_table_header():
     print('|-|-|-|-|')
 
 
-def to_github_table_row(stats):
-    return '|todo-iteration-name|{}|{}|{}|'.format(stats['mean'], stats['median'], stats['max'])
+def to_github_table_row(stats, label):
+    return '|{}|{}|{}|{}|'.format(label, stats['mean'], stats['median'], stats['max'])
+
+
+def get_label(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def compare_stats(baseline_stats, stats):
+    """Returns how the given stats changed relative to the baseline: the percent change of the medians, its
+    bootstrapped confidence interval, the Mann-Whitney U test's p-value, and a verdict.
+    """
+    baseline_replicates = baseline_stats[STATS_KEY_REPLICATES]
+    replicates = stats[STATS_KEY_REPLICATES]
+    ci_low, ci_high = perfmath.bootstrap_percent_change_ci(baseline_replicates, replicates)
+    if ci_low > 0:
+        verdict = COMPARISON_VERDICT_REGRESSION  # These are durations so higher is worse.
+    elif ci_high < 0:
+        verdict = COMPARISON_VERDICT_IMPROVEMENT
+    else:
+        verdict = COMPARISON_VERDICT_NO_CHANGE
+    return {
+        'median_percent_change': perfmath.percent_change(baseline_stats['median'], stats['median']),
+        'median_percent_change_ci': [ci_low, ci_high],
+        'mann_whitney_p_value': perfmath.mann_whitney_u(baseline_replicates, replicates).p_value,
+        'verdict': verdict,
+    }
+
+
+def print_comparison_table(labels, all_stats):
+    print('|Iteration desc|replicates|median|Δ median|Δ median 95% CI|p-value|verdict|')
+    print('|-|-|-|-|-|-|-|')
+    baseline_stats = all_stats[0]
+    print('|{} (baseline)|{}|{}|-|-|-|-|'.format(
+        labels[0], baseline_stats['replicate_count'], baseline_stats['median']))
+    for label, stats in zip(labels[1:], all_stats[1:]):
+        comparison = compare_stats(baseline_stats, stats)
+        ci_low, ci_high = comparison['median_percent_change_ci']
+        print('|{}|{}|{}|{:+.1f}%|[{:+.1f}%, {:+.1f}%]|{:.3g}|{}|'.format(
+            label, stats['replicate_count'], stats['median'], comparison['median_percent_change'], ci_low, ci_high,
+            comparison['mann_whitney_p_value'], comparison['verdict']))
 
 
 def save_output(stats, path):
@@ -146,8 +460,10 @@ def save_output(stats, path):
                          'exists: aborting to prevent accidental overwrites. Use stream '
                          'redirection operators for intentional overwriting.'))
 
+    # We write the stats on one line so several results can be concatenated into, and streamed from, one file.
     with open(path, 'x') as f:
-        print_stats(stats, f)
+        json.dump(stats, f, sort_keys=True)
+        f.write('\n')
 
     print('Saved output to path: {}'.format(path))
     print('Also printing to stdout...\n')
@@ -184,19 +500,210 @@ class InputFileType(Enum):
     PERFHERDER_JSON = auto()
     SCRIPT_OUTPUT = auto()
     LOGCAT = auto()
+    MEASUREMENT_RECORDS = auto()
 
     def read_from(self, path):
+        with map_file(path) as contents:
+            return self.parse(contents)
+
+    def parse(self, contents):
+        """Parses the replicates from the given bytes or memory map."""
         if self is InputFileType.NEWLINES:
-            return read_from_file_separated_by_newlines(path)
+            return parse_file_separated_by_newlines(contents)
         elif self is InputFileType.PERFHERDER_JSON:
-            return read_from_perfherder_json(path)
+            return parse_perfherder_json(contents)
         elif self is InputFileType.SCRIPT_OUTPUT:
-            return read_from_output(path)
+            return parse_output(contents)
         elif self is InputFileType.LOGCAT:
-            return read_from_logcat_file(path)
+            return parse_logcat(contents)
+        elif self is InputFileType.MEASUREMENT_RECORDS:
+            return parse_measurement_records(contents)
         raise RuntimeError('Unknown input type: {}'.format(self))
 
 
+def reject_replicates(replicates, outlier_method=None, trim_warm_up=False):
+    """Returns the indices of the replicates to keep and a description of each rejected replicate. The warm-up is
+    trimmed first so it doesn't skew the outlier detection.
+    """
+    kept_indices = list(range(len(replicates)))
+    rejected = []
+
+    def reject(indices, reason):
+        rejected.extend({'index': i, 'value': replicates[i], 'reason': reason} for i in indices)
+
+    if trim_warm_up:
+        warm_up_count = perfmath.get_warm_up_count(replicates)
+        reject(kept_indices[:warm_up_count], REJECTED_REASON_WARM_UP)
+        kept_indices = kept_indices[warm_up_count:]
+
+    if outlier_method:
+        get_outlier_mask = (perfmath.get_mad_outlier_mask if outlier_method == OUTLIER_METHOD_MAD
+                            else perfmath.get_iqr_outlier_mask)
+        is_outlier = get_outlier_mask([replicates[i] for i in kept_indices])
+        reject([i for i, o in zip(kept_indices, is_outlier) if o], outlier_method)
+        kept_indices = [i for i, o in zip(kept_indices, is_outlier) if not o]
+    return kept_indices, rejected
+
+
+def analyze_contents(contents, outlier_method=None, trim_warm_up=False):
+    filetype = detect_filetype_from_bytes(contents)
+    if filetype is InputFileType.MEASUREMENT_RECORDS:
+        # Only these inputs record the device's thermal state.
+        replicates, throttled_indices = parse_measurement_records_and_throttling(contents)
+    else:
+        replicates, throttled_indices = filetype.parse(contents), []
+    if not outlier_method and not trim_warm_up:
+        stats = to_stats(replicates)
+        flag_throttled_replicates(stats, throttled_indices)
+        return stats
+
+    kept_indices, rejected = reject_replicates(replicates, outlier_method, trim_warm_up)
+    stats = to_stats([replicates[i] for i in kept_indices])
+    stats[KEY_REJECTED_REPLICATES] = rejected
+    flag_throttled_replicates(stats, throttled_indices, kept_indices)
+    return stats
+
+
+def get_analysis_cache_path(contents, options=(), cache_dir=ANALYSIS_CACHE_DIR):
+    """Returns the cache path for the analysis of the given contents with the given options, which must be
+    repr-able consistently across runs.
+    """
+    content_hash = hashlib.sha256(contents)
+    content_hash.update(repr(options).encode('utf-8'))
+    return os.path.join(cache_dir, content_hash.hexdigest() + '.json')
+
+
+def read_analysis_cache(cache_path):
+    try:
+        with open(cache_path) as f:
+            entry = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    return entry['stats'] if entry.get('version') == ANALYSIS_CACHE_VERSION else None
+
+
+def write_analysis_cache(cache_path, stats):
+    # Several processes may analyze identical files concurrently so the write must be atomic.
+    fileutil.atomic_write_json(cache_path, {'version': ANALYSIS_CACHE_VERSION, 'stats': stats})
+
+
+def analyze_file(path, use_cache=True, bootstrap_ci=False, outlier_method=None, trim_warm_up=False):
+    """Returns the stats of the given file, reading it only once. If use_cache, the stats are cached by the hash
+    of the file's contents.
+    """
+    with map_file(path) as contents:
+        stats = None
+        if use_cache:
+            cache_path = get_analysis_cache_path(contents, (outlier_method, trim_warm_up))
+            stats = read_analysis_cache(cache_path)
+        if stats is None:
+            stats = analyze_contents(contents, outlier_method, trim_warm_up)
+            if use_cache:
+                write_analysis_cache(cache_path, stats)
+
+    # This isn't cached because it depends on the arguments but it's deterministic, and fast, anyway.
+    if bootstrap_ci:
+        stats[KEY_MEDIAN_BOOTSTRAP_CI] = list(perfmath.bootstrap_median_ci(stats['replicates']))
+    return stats
+
+
+def analyze_files(paths, jobs=1, **kwargs):
+    """Yields the stats of each of the given files, in order. If jobs > 1, the files are analyzed in that many
+    processes. kwargs are passed to analyze_file.
+    """
+    analyze = functools.partial(analyze_file, **kwargs)
+    if jobs == 1 or len(paths) == 1:
+        yield from map(analyze, paths)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(analyze, paths)
+
+
+def iter_lines(f, follow=False):
+    """Yields the lines of the given binary file as they are written. If follow, waits for more lines at the end of
+    the file rather than returning.
+    """
+    partial_line = b''
+    while True:
+        line = f.readline()
+        if not line:
+            if not follow:
+                break
+            time.sleep(FOLLOW_POLL_INTERVAL_SECONDS)
+            continue
+
+        # When following, the writer may not have finished the line yet.
+        if not line.endswith(b'\n'):
+            partial_line += line
+            if follow:
+                continue
+            line, partial_line = partial_line, b''
+        elif partial_line:
+            line, partial_line = partial_line + line, b''
+        yield line
+
+    if partial_line:
+        yield partial_line
+
+
+class StreamingStats:
+    """Running stats of an unbounded series of measurements, in constant memory."""
+
+    def __init__(self):
+        self._running_stats = perfmath.RunningStats()
+        self._quantiles = {percentile: perfmath.P2Quantile(percentile / 100)
+                           for percentile in [50] + STATS_PERCENTILES}
+
+    @property
+    def count(self):
+        return self._running_stats.count
+
+    def add(self, value):
+        self._running_stats.add(value)
+        for quantile in self._quantiles.values():
+            quantile.add(value)
+
+    def to_stats(self):
+        """Returns the stats, with the same keys as to_stats where possible. The percentiles are estimates."""
+        stats = {
+            'max': self._running_stats.max,
+            'mean': self._running_stats.mean,
+            'median': self._quantiles[50].value,
+            'min': self._running_stats.min,
+            'replicate_count': self._running_stats.count,
+            'stdev': self._running_stats.stdev,
+        }
+        for percentile in STATS_PERCENTILES:
+            stats['p{}'.format(percentile)] = self._quantiles[percentile].value
+        return stats
+
+
+def stream_logcat_stats(path, follow=False, update_interval=DEFAULT_STREAM_UPDATE_INTERVAL):
+    streaming_stats = StreamingStats()
+    f = sys.stdin.buffer if path == STDIN_PATH else open(path, 'rb')
+    try:
+        for line in iter_lines(f, follow):
+            value = parse_logcat_line(line.rstrip(b'\r\n'))
+            if value is None:
+                continue
+            streaming_stats.add(value)
+            if streaming_stats.count % update_interval == 0:
+                print_stats(streaming_stats.to_stats())
+                sys.stdout.flush()  # So the updates are seen promptly when piped.
+    except KeyboardInterrupt:
+        pass  # The expected way to stop following.
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+
+    if streaming_stats.count == 0:
+        print('WARN: no lines matched. expected format like:\n    {}'.format(LOGCAT_EXPECTED_FORMAT))
+        return
+    print('Final stats:')
+    print_stats(streaming_stats.to_stats())
+
+
 def main():
     args = parse_args()
     validate_args(args)
@@ -205,17 +712,24 @@ def main():
         print_github_table_header()
         exit(0)
 
-    for path in args.path:
-        filetype = detect_filetype(path)
-        measurement_arr = filetype.read_from(path)
-        stats = to_stats(measurement_arr)
+    if args.stream:
+        stream_logcat_stats(args.path[0], args.follow, args.update_interval)
+        return
+
+    labels = args.labels or [get_label(path) for path in args.path]
+    all_stats = analyze_files(args.path, args.jobs, use_cache=not args.no_cache, bootstrap_ci=args.bootstrap_ci,
+                              outlier_method=args.reject_outliers, trim_warm_up=args.trim_warm_up)
+    if args.compare:
+        print_comparison_table(labels, list(all_stats))
+        return
 
+    for path, label, stats in zip(args.path, labels, all_stats):
         # Called before printing so if we abort, it's clearer to the user there was an error.
         if args.output_safe:
             save_output(stats, args.output_safe)
 
         if args.print_github_table_row:
-            print(to_github_table_row(stats))
+            print(to_github_table_row(stats, label))
         else:
             maybe_print_header(len(args.path), path)
             print_stats(stats)
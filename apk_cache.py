@@ -0,0 +1,168 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""A content-addressed cache of APKs shared across backfill runs so builds aren't downloaded or built again.
+
+APKs are stored once per content hash in objects/ and looked up by a key describing the build, e.g.
+nightly/fenix/arm64-v8a/2021.09.01. When the cache exceeds its disk budget, the least recently used APKs are
+evicted.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import zipfile
+
+import fileutil
+
+DEFAULT_CACHE_DIR = os.path.join(fileutil.CACHE_DIR, 'apks')
+DEFAULT_BUDGET_BYTES = 10 * 1000 ** 3
+
+INDEX_FILENAME = 'index.json'
+OBJECTS_DIRNAME = 'objects'
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# The JAR signature files. Newer signature schemes are stored outside the zip entries so they're already ignored.
+SIGNATURE_ENTRY_PATTERN = re.compile(r'^META-INF/([^/]+\.(SF|RSA|DSA|EC)|SIG-[^/]*|MANIFEST\.MF)$', re.IGNORECASE)
+
+
+def get_nightly_key(product, architecture, date_str):
+    return '/'.join(['nightly', product, architecture, date_str])
+
+
+def get_commit_key(architecture, build_type, commit):
+    return '/'.join(['commit', architecture, build_type, commit])
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def hash_apk_contents(path):
+    """Hashes the names and uncompressed contents of the APK's entries, other than its signature files, so APKs
+    built from the same code have the same hash even if they were signed, or zipped, differently.
+    """
+    sha256 = hashlib.sha256()
+    with zipfile.ZipFile(path) as apk:
+        for info in sorted(apk.infolist(), key=lambda i: i.filename):
+            if info.is_dir() or SIGNATURE_ENTRY_PATTERN.match(info.filename):
+                continue
+
+            # The size delimits the entry so different splits of the same bytes into entries don't collide.
+            sha256.update('{}\0{}\0'.format(info.filename, info.file_size).encode('utf-8'))
+            with apk.open(info) as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def link_or_copy(src_path, dest_path):
+    """Hard links src_path to dest_path, so no disk space is used, or copies it if linking isn't possible, e.g.
+    across file systems. dest_path is replaced if it exists.
+    """
+    tmp_path = '{}.{}.tmp'.format(dest_path, os.getpid())
+    try:
+        os.link(src_path, tmp_path)
+    except OSError:
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dest_path)
+
+
+class ApkCache:
+    """The index maps each key to the hash of its APK and records the size and last use of each APK. It's only
+    safe to use from one process at a time but it can be shared between threads, e.g. concurrent downloads.
+
+    Usage:
+        cache = ApkCache()
+        if not cache.get(key, 'fenix.apk'):
+            download('fenix.apk')
+            cache.put(key, 'fenix.apk')
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, budget_bytes=DEFAULT_BUDGET_BYTES):
+        self.cache_dir = cache_dir
+        self.budget_bytes = budget_bytes
+        self._index_path = os.path.join(cache_dir, INDEX_FILENAME)
+        self._objects_dir = os.path.join(cache_dir, OBJECTS_DIRNAME)
+        self._lock = threading.Lock()
+        self._index = self._read_index()
+
+    def _read_index(self):
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {'keys': {}, 'objects': {}}
+
+    def _write_index(self):
+        fileutil.atomic_write_json(self._index_path, self._index, indent=2, sort_keys=True)
+
+    def _get_object_path(self, content_hash):
+        return os.path.join(self._objects_dir, content_hash + '.apk')
+
+    def get(self, key, dest_path):
+        """If the APK for key is cached, puts it at dest_path and returns True. Otherwise, returns False."""
+        with self._lock:
+            content_hash = self._index['keys'].get(key)
+            if not content_hash:
+                return False
+            object_path = self._get_object_path(content_hash)
+            if not os.path.exists(object_path):
+                # e.g. the object was deleted manually.
+                del self._index['keys'][key]
+                self._index['objects'].pop(content_hash, None)
+                self._write_index()
+                return False
+
+            link_or_copy(object_path, dest_path)
+            self._index['objects'][content_hash]['last_used'] = time.time()
+            self._write_index()
+            return True
+
+    def put(self, key, src_path):
+        """Adds the APK at src_path to the cache under key and evicts the least recently used APKs, other than
+        this one, until the cache is within its budget. Returns the APK's hash.
+        """
+        content_hash = hash_file(src_path)
+        with self._lock:
+            object_path = self._get_object_path(content_hash)
+            if not os.path.exists(object_path):
+                os.makedirs(self._objects_dir, exist_ok=True)
+                link_or_copy(src_path, object_path)
+
+            self._index['keys'][key] = content_hash
+            self._index['objects'][content_hash] = {
+                'size': os.path.getsize(object_path),
+                'last_used': time.time(),
+            }
+            self._evict(keep_hash=content_hash)
+            self._write_index()
+        return content_hash
+
+    def _evict(self, keep_hash):
+        objects = self._index['objects']
+        total_bytes = sum(entry['size'] for entry in objects.values())
+        for content_hash, entry in sorted(objects.items(), key=lambda e: e[1]['last_used']):
+            if total_bytes <= self.budget_bytes:
+                break
+            if content_hash == keep_hash:
+                continue
+
+            print('Evicting {} ({:.1f} MB) from the APK cache.'.format(content_hash, entry['size'] / 1e6))
+            try:
+                os.remove(self._get_object_path(content_hash))
+            except FileNotFoundError:
+                pass
+            del objects[content_hash]
+            self._index['keys'] = {k: h for k, h in self._index['keys'].items() if h != content_hash}
+            total_bytes -= entry['size']
@@ -2,14 +2,27 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import adb
+import apk_cache
 import argparse
+import collections
+import fileutil
+import glob
+import itertools
+import json
+import threading
 import urllib.request
 import subprocess
 import analyze_durations
 import os
 import sys
 import measure_start_up
+import re
+import results_store
 import time
+import worktree_pool
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from measure_start_up import PROD_TO_CHANNEL_TO_PKGID, PROD_FENIX, PROD_FOCUS
 from datetime import datetime, timedelta
@@ -19,24 +32,46 @@ DESCRIPTION = """ Allows to get startup performance metrics between two dates.
 This can backfill numbers for either daily nightlys or for two commits.
 """
 
+DEFAULT_TASKCLUSTER_INDEX_URL = "https://firefox-ci-tc.services.mozilla.com/api/index/v1/task/"
+
 BASE_URL_DICT = {}
-BASE_URL_DICT[PROD_FENIX] = ("https://firefox-ci-tc.services.mozilla.com/api/index/v1/task/"
+BASE_URL_DICT[PROD_FENIX] = ("{index_url}"
                              "mobile.v2.fenix.nightly.{date}.latest.{architecture}/artifacts/"
                              "public%2Fbuild%2F{architecture}%2Ftarget.apk")
 # Despite the URL including "unsigned", these are actually signed builds.
-BASE_URL_DICT[PROD_FOCUS] = ("https://firefox-ci-tc.services.mozilla.com/api/index/v1/task/"
+BASE_URL_DICT[PROD_FOCUS] = ("{index_url}"
                              "mobile.v2.focus-android.nightly.{date}.latest.{architecture}/artifacts/"
                              "public%2Fbuild%2Fapp-focus-{architecture}-nightly-unsigned.apk")
 # See usage for why this exists.
-BASE_URL_DICT[PROD_FOCUS + '-v2'] = ("https://firefox-ci-tc.services.mozilla.com/api/index/v1/task/"
+BASE_URL_DICT[PROD_FOCUS + '-v2'] = ("{index_url}"
                                      "mobile.v2.focus-android.nightly.{date}.latest.{architecture}/artifacts/"
                                      "public%2Fbuild%2Ffocus%2F{architecture}%2Ftarget.apk")
 
+# The number of APKs downloaded ahead of the one being measured.
+DEFAULT_DOWNLOAD_PREFETCH_COUNT = 2
+# The number of commits built ahead of the one being measured.
+DEFAULT_BUILD_LOOKAHEAD_COUNT = 1
+# The number of commits built concurrently, each in its own worktree.
+DEFAULT_BUILD_WORKER_COUNT = 1
+CLEAN_BUILD_ARGS = ["./gradlew", "clean"]
 
-BACKFILL_DIR = "backfill_output"
 
-DURATIONS_OUTPUT_FILE_TEMPLATE = "{run_number}-{apk_name}-{test_name}-durations.txt"
-ANALYZED_DURATIONS_FILE_TEMPLATE = "{run_number}-{apk_name}-{test_name}-analysis.txt"
+BACKFILL_DIR = "backfill_output"
+RESULTS_STORE_PATH = os.path.join(BACKFILL_DIR, "results.sqlite")
+
+# The files are named after the build, rather than its position in the run, so a repeated run, e.g. with --resume,
+# finds the same build's files even if other builds are unavailable this time.
+DURATIONS_OUTPUT_FILE_TEMPLATE = "{apk_name}-{test_name}-durations.txt"
+ANALYZED_DURATIONS_FILE_TEMPLATE = "{apk_name}-{test_name}-analysis.txt"
+# Earlier runs prefixed the files with the build's position in the run.
+LEGACY_ANALYZED_DURATIONS_FILE_TEMPLATE = "[0-9]*-{apk_name}-{test_name}-analysis.txt"
+BISECT_LOG_FILE_TEMPLATE = "bisect-{start_commit}-{end_commit}-{test_name}.json"
+# Matches the file names of ANALYZED_DURATIONS_FILE_TEMPLATE and its legacy version. Test names don't contain dashes
+# and APK names don't start with digits.
+ANALYZED_DURATIONS_FILE_PATTERN = re.compile(r"^(?:\d+-)?(?P<apk_name>.+)-(?P<test_name>[^-]+)-analysis\.txt$")
+# Nightly APK names contain their date, e.g. fenix_nightly_arm64-v8a_2021_09_01, and commit APK names their commit.
+APK_NAME_DATE_PATTERN = re.compile(r"(\d{4})_(\d{2})_(\d{2})")
+APK_NAME_COMMIT_PATTERN = re.compile(r"^apk_commit_([0-9a-f]+)$")
 
 BUILD_SRC_TASKCLUSTER = "taskclusterNightly"
 BUILD_SRC_COMMITS = "commitsRange"
@@ -48,11 +83,18 @@ KEY_DATETIME = "date"
 KEY_COMMIT = "commit"
 KEY_ARCHITECTURE = "architecture"
 KEY_TEST_NAME = "test_name"
+KEY_DEVICE = "device"
+KEY_APK_HASH = "apk_hash"
+KEY_REUSED_FROM = "reused_measurement_from"
 
 DATETIME_FORMAT = "%Y.%m.%d"
 
 MEASURE_START_UP_SCRIPT = "./measure_start_up.py"
 
+# The activity each test's intent launches, keyed by the APK's file hash, so it's resolved once per APK.
+COMPONENT_NAME_CACHE_PATH = os.path.join(fileutil.CACHE_DIR, "component_names.json")
+component_name_cache_lock = threading.Lock()
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description=DESCRIPTION)
@@ -86,33 +128,108 @@ def parse_args():
     parser.add_argument("-c", "--cleanup", action="store_true",
                         help="Remove all apks downloaded since they can takeup lots of space")
 
+    parser.add_argument("--resume", action="store_true",
+                        help=("continue an interrupted backfill: builds and tests with an existing analysis in {} are "
+                              "skipped and partially measured tests continue from their last iteration".format(
+                                  BACKFILL_DIR)))
+    parser.add_argument("--bisect", action="store_true",
+                        help=("with {}, finds the commit that changed the startup duration rather than measuring "
+                              "every commit: the endpoints are measured and then midpoints, requiring O(log n) "
+                              "builds. The first of --tests is used. Each result is logged to {} so the bisection "
+                              "can be continued with --resume").format(BUILD_SRC_COMMITS, BACKFILL_DIR))
+    parser.add_argument("--prefetch", type=int, default=DEFAULT_DOWNLOAD_PREFETCH_COUNT,
+                        help=("the number of nightlies to download, concurrently, while the current one is measured. "
+                              "defaults to {}").format(DEFAULT_DOWNLOAD_PREFETCH_COUNT))
+    parser.add_argument("--build-lookahead", type=int, default=DEFAULT_BUILD_LOOKAHEAD_COUNT,
+                        help=("with {}, the number of commits to build while the current one is measured. 0 builds "
+                              "each commit only once the previous one is measured. defaults to {}").format(
+                                  BUILD_SRC_COMMITS, DEFAULT_BUILD_LOOKAHEAD_COUNT))
+    parser.add_argument("--build-workers", type=int, default=DEFAULT_BUILD_WORKER_COUNT,
+                        help=("with {}, the number of commits to build concurrently. Each worker builds in its own "
+                              "git worktree, kept in {} to reuse its incremental build state across commits and "
+                              "runs, so your checkout is untouched. The lookahead is raised to at least this. "
+                              "defaults to {}").format(BUILD_SRC_COMMITS, worktree_pool.DEFAULT_WORKTREES_DIR,
+                                                       DEFAULT_BUILD_WORKER_COUNT))
+    parser.add_argument("--clean-worktrees", action="store_true",
+                        help=("with {}, run `{}` in each build worktree before its first build in this run, e.g. if "
+                              "its incremental build state from an earlier run may be stale").format(
+                                  BUILD_SRC_COMMITS, " ".join(CLEAN_BUILD_ARGS)))
+    parser.add_argument("--taskcluster-index-url", default=DEFAULT_TASKCLUSTER_INDEX_URL,
+                        help=("the Taskcluster index API to download nightlies from, e.g. a local mirror. defaults "
+                              "to {}").format(DEFAULT_TASKCLUSTER_INDEX_URL))
+    parser.add_argument("--apk-cache-budget-gb", type=float, default=apk_cache.DEFAULT_BUDGET_BYTES / 1000 ** 3,
+                        help=("the disk space the APK cache, in {}, may use before the least recently used APKs "
+                              "are evicted. defaults to {}").format(apk_cache.DEFAULT_CACHE_DIR,
+                                                                    apk_cache.DEFAULT_BUDGET_BYTES / 1000 ** 3))
+    parser.add_argument("--no-dedupe", action="store_true",
+                        help=("measure every APK. By default, an APK whose contents, ignoring its signature, are "
+                              "identical to one already measured on the same device model and test reuses that "
+                              "measurement, e.g. for commits that don't change the app's code"))
+    parser.add_argument("--no-apk-cache", action="store_true",
+                        help=("always download or build the APKs. By default, they are cached across runs, keyed by "
+                              "the product, architecture, and date or commit"))
+    parser.add_argument("--adaptive", action="store_true",
+                        help=("run each test until its median is precise enough rather than for a fixed number of "
+                              "iterations: see --adaptive in `python3 measure_start_up.py --help`"))
+
+    device_group = parser.add_mutually_exclusive_group()
+    device_group.add_argument("--devices", nargs="+", metavar="SERIAL",
+                              help=("the serials of the devices to measure on, as listed by `adb devices`. Builds "
+                                    "are split between the devices, which should be identical, and measured "
+                                    "concurrently"))
+    device_group.add_argument("--all-devices", action="store_true",
+                              help="like --devices but uses every device listed by `adb devices`")
+
     return parser.parse_args()
 
 
-def get_nightly_url(download_date, download_date_str, product, architecture):
+def get_nightly_url(download_date, download_date_str, product, architecture,
+                    index_url=DEFAULT_TASKCLUSTER_INDEX_URL):
     # The url format changed for builds after this date.
     if product == PROD_FOCUS and download_date >= datetime(2021, 11, 5):
         product += '-v2'
-    return BASE_URL_DICT[product].format(date=download_date_str, architecture=architecture)
+    return BASE_URL_DICT[product].format(index_url=index_url, date=download_date_str, architecture=architecture)
 
 
-def fetch_nightly(download_date, architecture, product):
+def fetch_nightly(download_date, architecture, product, tests=None, resume=False,
+                  index_url=DEFAULT_TASKCLUSTER_INDEX_URL, progress_desc="", cache=None):
     download_date_string = datetime.strftime(download_date, DATETIME_FORMAT)
-    nightly_url = get_nightly_url(download_date, download_date_string, product, architecture)
+    nightly_url = get_nightly_url(download_date, download_date_string, product, architecture, index_url)
     filename = "{}_nightly_{}_{}.apk".format(product, architecture, download_date_string.replace(".", "_"))
-    print("Fetching {}...".format(filename), end="", flush=True)
+    apk_metadata = {KEY_NAME: filename, KEY_DATETIME: download_date, KEY_COMMIT: "", KEY_ARCHITECTURE: architecture,
+                    KEY_PRODUCT: product}
+
+    if resume and (Path(filename).exists() or are_all_tests_analyzed(get_apk_name(apk_metadata), tests)):
+        print("Skipping download of {}: it was already downloaded or analyzed.".format(filename))
+        return apk_metadata
+
+    cache_key = apk_cache.get_nightly_key(product, architecture, download_date_string)
+    if cache and cache.get(cache_key, filename):
+        print("{}Using cached {}.".format(progress_desc, filename), flush=True)
+        return apk_metadata
+
+    # Downloads run concurrently with each other and with the measurements so we print whole lines.
+    print("{}Fetching {}...".format(progress_desc, filename), flush=True)
+    start = time.monotonic()
+    # We download to a temporary file so an interrupted download isn't mistaken for a complete APK by --resume.
+    partial_filename = filename + ".part"
     try:
-        urllib.request.urlretrieve(nightly_url, filename=filename)
+        urllib.request.urlretrieve(nightly_url, filename=partial_filename)
     except urllib.error.HTTPError as err:
         if err.code == 404:
             print("\n\nThe apk for {date} is not available at this {url}".format(date=download_date, url=nightly_url),
                   file=sys.stderr)
         return None
+    os.replace(partial_filename, filename)
+    if cache:
+        cache.put(cache_key, filename)
 
-    print(" Success.")
+    elapsed_seconds = time.monotonic() - start
+    size_mb = os.path.getsize(filename) / 1e6
+    print("{}Fetched {}: {:.1f} MB in {:.1f}s ({:.1f} MB/s).".format(
+        progress_desc, filename, size_mb, elapsed_seconds, size_mb / max(elapsed_seconds, 1e-3)), flush=True)
 
-    return {KEY_NAME: filename, KEY_DATETIME: download_date, KEY_COMMIT: "", KEY_ARCHITECTURE: architecture,
-            KEY_PRODUCT: product}
+    return apk_metadata
 
 
 def get_date_array_for_range(startdate, enddate):
@@ -120,14 +237,58 @@ def get_date_array_for_range(startdate, enddate):
     return [startdate + timedelta(days=i) for i in range(delta_dates)]
 
 
-def download_nightly_for_range(array_of_dates, architecture, product):
-    # TODO if file exist and no -f option
-    apk_metadata_array = [fetch_nightly(date, architecture, product) for date in array_of_dates]
-    return [e for e in apk_metadata_array if e is not None]
-
-
-def install_apk(apk_build_path):
-    install_proc = subprocess.run(["adb", "install", apk_build_path], check=False, capture_output=True)
+def iter_prefetched(fn, items, prefetch_count, max_workers=None):
+    """Yields fn(item) for each item, in order, while computing the results for up to prefetch_count of the
+    following items on background threads. This lets slow producers, e.g. downloads, overlap with the consumer,
+    e.g. measurements, while bounding how far ahead, and how much disk, the producers use. Exceptions raised by fn
+    are raised when its result is yielded.
+
+    By default, the prefetched items are computed concurrently: max_workers limits this, e.g. to 1 if fn can't
+    run concurrently with itself.
+    """
+    items = iter(items)
+    end = object()
+    if max_workers is None:
+        max_workers = prefetch_count
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        pending = collections.deque(executor.submit(fn, item) for item in itertools.islice(items, prefetch_count))
+        try:
+            while True:
+                if not pending:
+                    item = next(items, end)
+                    if item is end:
+                        return
+                    pending.append(executor.submit(fn, item))
+
+                result = pending.popleft().result()
+                # We top up before yielding so the next items are produced while the consumer uses this result.
+                for item in itertools.islice(items, prefetch_count - len(pending)):
+                    pending.append(executor.submit(fn, item))
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()  # e.g. if the consumer stopped early: don't start the remaining work.
+
+
+def download_nightly_for_range(array_of_dates, architecture, product, tests=None, resume=False,
+                               prefetch_count=DEFAULT_DOWNLOAD_PREFETCH_COUNT,
+                               index_url=DEFAULT_TASKCLUSTER_INDEX_URL, cache=None):
+    """Yields the metadata of each nightly as soon as it's downloaded while downloading up to prefetch_count of the
+    following nightlies in the background. Nightlies that aren't available are skipped.
+    """
+    def fetch(indexed_date):
+        index, date = indexed_date
+        progress_desc = "[{}/{}] ".format(index + 1, len(array_of_dates))
+        return fetch_nightly(date, architecture, product, tests, resume, index_url, progress_desc, cache)
+
+    for apk_metadata in iter_prefetched(fetch, enumerate(array_of_dates), prefetch_count):
+        if apk_metadata is not None:
+            yield apk_metadata
+
+
+def install_apk(apk_build_path, serial=None):
+    install_proc = subprocess.run(adb.get_adb_args(serial) + ["install", apk_build_path], check=False,
+                                  capture_output=True)
     if install_proc.returncode != 0:
         print(("\nUnable to install: {apk}. The associated error message was:\n"
                "{error}".format(apk=apk_build_path, error=install_proc.stderr.decode('utf-8'))),
@@ -136,23 +297,25 @@ def install_apk(apk_build_path):
     return True
 
 
-def uninstall_apk(package_id):
-    uninstall_proc = subprocess.run(["adb", "uninstall", package_id], check=False, capture_output=True)
+def uninstall_apk(package_id, serial=None):
+    uninstall_proc = subprocess.run(adb.get_adb_args(serial) + ["uninstall", package_id], check=False,
+                                    capture_output=True)
     if uninstall_proc.returncode != 0:
         print(("\nUnable to uninstall {package_id}. The associated error message was:\n"
                "{error}".format(package_id=package_id, error=uninstall_proc.stderr.decode('utf-8'))),
               file=sys.stderr)
 
 
-def clear_app_data(package_id):
-    clear_proc = subprocess.run(['adb', 'shell', 'pm', 'clear', package_id], check=False, capture_output=True)
+def clear_app_data(package_id, serial=None):
+    clear_proc = subprocess.run(adb.get_adb_args(serial) + ['shell', 'pm', 'clear', package_id], check=False,
+                                capture_output=True)
     if clear_proc.returncode != 0:
         print(("\nUnable to clear app data for {package_id}. The associated error message was:\n"
                "{error}".format(package_id=package_id, error=clear_proc.stderr.decode('utf-8'))),
               file=sys.stderr)
 
 
-def maybe_skip_onboarding(package_id, test_name, product):
+def maybe_skip_onboarding(package_id, test_name, product, serial=None):
     # We skip onboarding for focus in measure_start_up.py because it's stateful and needs to be called
     # for every cold start intent.
     if product == PROD_FOCUS:
@@ -164,10 +327,11 @@ def maybe_skip_onboarding(package_id, test_name, product):
         return
 
     # This sets mutable state so we only need to pass this flag once, before we start the actual test.
-    start_proc = subprocess.run(['adb', 'shell', 'am', 'start-activity', '-W',
-                                 '-a', 'android.intent.action.MAIN',
-                                 '--ez', 'performancetest', 'true',  # Skip onboarding.
-                                 '-n' '{}/org.mozilla.fenix.App'.format(package_id)],
+    start_proc = subprocess.run(adb.get_adb_args(serial) + [
+                                    'shell', 'am', 'start-activity', '-W',
+                                    '-a', 'android.intent.action.MAIN',
+                                    '--ez', 'performancetest', 'true',  # Skip onboarding.
+                                    '-n' '{}/org.mozilla.fenix.App'.format(package_id)],
                                 check=False, capture_output=True)
     if start_proc.returncode != 0:
         print(("\nUnable to skip onboarding. The associated error message was:\n"
@@ -177,62 +341,286 @@ def maybe_skip_onboarding(package_id, test_name, product):
     time.sleep(4)  # ensure skip onboarding call has time to propagate.
 
 
-def run_measure_start_up_script(path_to_measure_start_up_script, durations_output_path, build_type, test_name, product):
-    subprocess.run([path_to_measure_start_up_script, "--product=" + product, build_type, test_name,
-                    # The iteration count is chosen manually, through trial-and-error,
-                    # to minimize both execution time and noise.
-                    '--iter-count', '30',
-                    durations_output_path], stdout=subprocess.PIPE, check=False)
+def run_measure_start_up_script(path_to_measure_start_up_script, durations_output_path, build_type, test_name, product,
+                                serial=None, adaptive=False, resume=False, component_name=None):
+    args = [path_to_measure_start_up_script, "--product=" + product, build_type, test_name, durations_output_path]
+    if component_name:
+        args += ['--component', component_name]
+    if adaptive:
+        # Never run more iterations than the fixed count below.
+        args += ['--adaptive', '--max-iter-count', '30']
+    else:
+        # The iteration count is chosen manually, through trial-and-error,
+        # to minimize both execution time and noise.
+        args += ['--iter-count', '30']
+    if serial:
+        args += ['--serial', serial]
+    if resume:
+        args += ['--resume']
+    subprocess.run(args, stdout=subprocess.PIPE, check=False)
+
 
+def get_apk_name(apk_metadata):
+    return apk_metadata[KEY_NAME].split(".")[0]
 
-def analyze_nightly_for_one_build(index, package_id, path_to_measure_start_up_script, apk_metadata, build_type, tests,
-                                  product):
-    uninstall_apk(package_id)
 
-    print("Installing {}...".format(apk_metadata[KEY_NAME]))
-    was_install_successful = install_apk(apk_metadata[KEY_NAME])
+def find_analysis_path(apk_name, test_name):
+    """Returns the path to an analysis of this build and test from any run, e.g. one that was interrupted, or None.
+    This is only meant for --resume: the analysis may be stale.
+    """
+    analysis_path = os.path.join(BACKFILL_DIR, ANALYZED_DURATIONS_FILE_TEMPLATE.format(
+        apk_name=apk_name, test_name=test_name))
+    if os.path.exists(analysis_path):
+        return analysis_path
+    legacy_analysis_paths = sorted(glob.glob(os.path.join(BACKFILL_DIR, LEGACY_ANALYZED_DURATIONS_FILE_TEMPLATE.format(
+        apk_name=glob.escape(apk_name), test_name=test_name))))
+    return legacy_analysis_paths[0] if legacy_analysis_paths else None
+
+
+def is_test_analyzed(apk_name, test_name):
+    return find_analysis_path(apk_name, test_name) is not None
+
+
+def are_all_tests_analyzed(apk_name, tests):
+    return all(is_test_analyzed(apk_name, test_name) for test_name in tests)
+
+
+def get_apk_hash(apk_path):
+    """Returns the hash of the APK's contents, ignoring its signature, or None if it isn't a valid APK."""
+    try:
+        return apk_cache.hash_apk_contents(apk_path)
+    except (OSError, zipfile.BadZipFile):
+        return None
+
+
+def read_component_name_cache(cache_path):
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def get_component_name(apk_file_hash, package_id, test_name, serial=None, cache_path=COMPONENT_NAME_CACHE_PATH):
+    """Returns the activity the test's intent launches in the installed APK, whose file hash is apk_file_hash, or
+    None if it couldn't be resolved. The component only depends on the APK so it's resolved on the device the first
+    time the APK is measured and then read from the cache on the host, in this run and later ones.
+    """
+    intent = measure_start_up.get_intent_for_test(test_name)
+    cache_key = " ".join([apk_file_hash, package_id] + intent)
+    with component_name_cache_lock:
+        component_name = read_component_name_cache(cache_path).get(cache_key)
+    if component_name:
+        return component_name
+
+    proc = subprocess.run(adb.get_adb_args(serial) + ["shell"] +
+                          measure_start_up.get_resolve_activity_args(package_id, intent),
+                          check=False, capture_output=True)
+    component_name = measure_start_up.parse_resolved_component_name(proc.stdout)
+    if proc.returncode != 0 or not component_name:
+        # measure_start_up.py will try to resolve it itself and report the error.
+        return None
+
+    with component_name_cache_lock:
+        cache = read_component_name_cache(cache_path)
+        cache[cache_key] = component_name
+        fileutil.atomic_write_json(cache_path, cache, indent=2, sort_keys=True)
+    return component_name
+
+
+def add_result_to_store(store, run_id, apk_metadata, stats, analysis_path):
+    store.add_result(run_id, get_apk_name(apk_metadata), stats[KEY_TEST_NAME], stats, stats.get(KEY_DEVICE),
+                     stats.get(KEY_PRODUCT), apk_metadata.get(KEY_ARCHITECTURE), apk_metadata.get(KEY_DATETIME),
+                     apk_metadata.get(KEY_COMMIT), stats.get(KEY_APK_HASH), analysis_path)
+
+
+def import_legacy_results(store, backfill_dir=BACKFILL_DIR):
+    """Adds the analyses in backfill_dir that aren't in the store yet, e.g. from runs before the store existed, to
+    the store. The build's date or commit is taken from its APK name. Returns the number of analyses added.
+    """
+    run_id = None
+    imported_count = 0
+    for filename in sorted(os.listdir(backfill_dir)):
+        match = ANALYZED_DURATIONS_FILE_PATTERN.match(filename)
+        analysis_path = os.path.join(backfill_dir, filename)
+        if not match or store.has_result(analysis_path):
+            continue
+
+        try:
+            stats = analyze_durations.load_stats(analysis_path)
+        except (ValueError, SyntaxError):
+            print("Unable to import {}: it isn't a valid analysis.".format(analysis_path), file=sys.stderr)
+            continue
+
+        apk_name = match.group("apk_name")
+        date_match = APK_NAME_DATE_PATTERN.search(apk_name)
+        commit_match = APK_NAME_COMMIT_PATTERN.match(apk_name)
+        if run_id is None:
+            run_id = store.start_run("import of {}".format(backfill_dir))
+        if store.add_result(run_id, apk_name, stats.get(KEY_TEST_NAME, match.group("test_name")), stats,
+                            stats.get(KEY_DEVICE), stats.get(KEY_PRODUCT),
+                            date="-".join(date_match.groups()) if date_match else None,
+                            commit=commit_match.group(1) if commit_match else None,
+                            apk_hash=stats.get(KEY_APK_HASH), source_path=analysis_path):
+            imported_count += 1
+    return imported_count
+
+
+def analyze_nightly_for_one_build(package_id, path_to_measure_start_up_script, apk_metadata, build_type, tests,
+                                  product, serial=None, device_model=None, adaptive=False, resume=False,
+                                  dedupe=False, store=None, run_id=None):
+    """Measures the build with each test. Each result is added to the store, if any, as soon as it's analyzed. If
+    dedupe is True, tests that the store has a result of on an identical APK and the same device model reuse that
+    result instead. Returns a dict of each analyzed test's name to the path of its analysis, from this call or, with
+    resume, an earlier run, and the (test name, reused analysis path) of each reused result.
+    """
+    # Identifies the device in the output when several devices are measured concurrently.
+    device_desc = " on {}".format(serial) if serial else ""
+
+    apk_name = get_apk_name(apk_metadata)
+    analysis_paths = {}
+    if resume:
+        tests_to_measure = []
+        for test_name in tests:
+            analysis_path = find_analysis_path(apk_name, test_name)
+            if analysis_path:
+                analysis_paths[test_name] = analysis_path
+            else:
+                tests_to_measure.append(test_name)
+        tests = tests_to_measure
+        if not tests:
+            print("Skipping {}: all tests were already analyzed.".format(apk_name))
+            return analysis_paths, []
+
+    # Hashing decompresses the whole APK so we only do it when it's needed.
+    apk_hash = get_apk_hash(apk_metadata[KEY_NAME]) if dedupe and store else None
+    reused = []
+    if apk_hash:
+        tests_to_measure = []
+        for test_name in tests:
+            reused_path, stats = store.find_result_by_apk_hash(apk_hash, test_name, device_model)
+            if stats is None:
+                tests_to_measure.append(test_name)
+                continue
+
+            print("Reusing the {test_name} measurement of {reused_path}: its APK is identical to {apk_name}.".format(
+                test_name=test_name, reused_path=reused_path, apk_name=apk_name))
+            # The reused result may itself be reused: we point to the original measurement.
+            stats[KEY_REUSED_FROM] = stats.get(KEY_REUSED_FROM) or os.path.basename(reused_path)
+            analyzed_durations_path = os.path.join(BACKFILL_DIR, ANALYZED_DURATIONS_FILE_TEMPLATE.format(
+                apk_name=apk_name, test_name=test_name))
+            analyze_durations.save_output(stats, analyzed_durations_path)
+            add_result_to_store(store, run_id, apk_metadata, stats, analyzed_durations_path)
+            analysis_paths[test_name] = analyzed_durations_path
+            reused.append((test_name, reused_path))
+        tests = tests_to_measure
+        if not tests:
+            return analysis_paths, reused
+
+    uninstall_apk(package_id, serial)
+
+    print("Installing {}{}...".format(apk_metadata[KEY_NAME], device_desc))
+    was_install_successful = install_apk(apk_metadata[KEY_NAME], serial)
     if was_install_successful:
         Path(BACKFILL_DIR).mkdir(parents=True, exist_ok=True)
-
-        apk_name = apk_metadata[KEY_NAME].split(".")[0]
+        # Unlike apk_hash, this is cheap: the file isn't decompressed.
+        apk_file_hash = apk_cache.hash_file(apk_metadata[KEY_NAME])
 
         for test_name in tests:
-            print("Running {test_name} on {apk_name}...".format(test_name=test_name, apk_name=apk_name))
+            print("Running {test_name} on {apk_name}{device_desc}...".format(
+                test_name=test_name, apk_name=apk_name, device_desc=device_desc))
 
-            clear_app_data(package_id)  # Don't maintain state between tests.
-            maybe_skip_onboarding(package_id, test_name, product)
+            clear_app_data(package_id, serial)  # Don't maintain state between tests.
+            maybe_skip_onboarding(package_id, test_name, product, serial)
 
             # TODO fix verify if file exist to have -f in this script
             durations_output_path = os.path.join(BACKFILL_DIR, DURATIONS_OUTPUT_FILE_TEMPLATE.format(
-                run_number=index, apk_name=apk_name, test_name=test_name))
+                apk_name=apk_name, test_name=test_name))
             analyzed_durations_path = os.path.join(BACKFILL_DIR, ANALYZED_DURATIONS_FILE_TEMPLATE.format(
-                run_number=index, apk_name=apk_name, test_name=test_name))
+                apk_name=apk_name, test_name=test_name))
+            component_name = get_component_name(apk_file_hash, package_id, test_name, serial)
             run_measure_start_up_script(path_to_measure_start_up_script, durations_output_path, build_type, test_name,
-                                        product)
-            get_result_from_durations(durations_output_path, analyzed_durations_path, test_name, product)
-
-
-def get_result_from_durations(start_up_durations_path, analyzed_path, test_name, product):
+                                        product, serial, adaptive, resume, component_name)
+            stats = get_result_from_durations(durations_output_path, analyzed_durations_path, test_name, product,
+                                              device_model, apk_hash)
+            if stats:
+                analysis_paths[test_name] = analyzed_durations_path
+                if store:
+                    add_result_to_store(store, run_id, apk_metadata, stats, analyzed_durations_path)
+    return analysis_paths, reused
+
+
+def get_result_from_durations(start_up_durations_path, analyzed_path, test_name, product, device_model=None,
+                              apk_hash=None):
+    """Analyzes the durations, saves the stats to analyzed_path, and returns them or None if there were no
+    durations.
+    """
     try:
-        filetype = analyze_durations.detect_filetype(start_up_durations_path)
+        stats = analyze_durations.analyze_file(start_up_durations_path, use_cache=False)
     except FileNotFoundError:
         print(("The file {file} doesn't exist, this is probably due to a failure in running"
                "the measure_start_up.py for the apk with the according date").format(file=start_up_durations_path),
               file=sys.stderr)
-        return
+        return None
 
-    measurement_arr = filetype.read_from(start_up_durations_path)
-    stats = analyze_durations.to_stats(measurement_arr)
     stats[KEY_TEST_NAME] = test_name
     stats[KEY_PRODUCT] = product
+    if device_model:
+        stats[KEY_DEVICE] = device_model
+    if apk_hash:
+        stats[KEY_APK_HASH] = apk_hash
     analyze_durations.save_output(stats, analyzed_path)
+    return stats
 
 
 def run_performance_analysis_on_nightly(package_id, path_to_measure_start_up_script, array_of_apk_path, build_type,
-                                        tests, product):
-    for idx, apk_path in enumerate(array_of_apk_path):
-        analyze_nightly_for_one_build(idx, package_id, path_to_measure_start_up_script, apk_path, build_type, tests,
-                                      product)
+                                        tests, product, serials=None, adaptive=False, resume=False, dedupe=False,
+                                        store=None, run_id=None):
+    """Measures each build on one of the given devices. Each device has its own worker that takes the next
+    unmeasured build when it finishes the previous one so identical devices are kept busy. If no serials are
+    given, the builds are measured serially on the default device.
+
+    The results are added to the store, if any, under run_id. If dedupe is True and there's a store, builds
+    identical to ones already measured reuse their results: see analyze_nightly_for_one_build. Returns a dict of
+    each build's APK name to the analysis paths of its tests, as returned by analyze_nightly_for_one_build.
+    """
+    if not serials:
+        serials = [None]
+
+    apks = iter(array_of_apk_path)
+    apks_lock = threading.Lock()
+    build_count = 0
+    reused = []  # (apk name, test name, reused analysis path)
+    apk_name_to_analysis_paths = {}
+
+    def measure_on_device(serial):
+        nonlocal build_count
+        device_model = adb.get_device_model(serial)
+        while True:
+            with apks_lock:
+                apk_path = next(apks, None)
+                if apk_path is not None:
+                    build_count += 1
+            if apk_path is None:
+                return
+            analysis_paths, build_reused = analyze_nightly_for_one_build(
+                package_id, path_to_measure_start_up_script, apk_path, build_type, tests, product, serial,
+                device_model, adaptive, resume, dedupe, store, run_id)
+            apk_name_to_analysis_paths[get_apk_name(apk_path)] = analysis_paths
+            for test_name, reused_path in build_reused:
+                reused.append((get_apk_name(apk_path), test_name, reused_path))
+
+    with ThreadPoolExecutor(max_workers=len(serials)) as executor:
+        futures = [executor.submit(measure_on_device, serial) for serial in serials]
+    for future in futures:
+        future.result()  # Raises any exception from the worker.
+
+    if dedupe:
+        print("\nProcessed {} builds: {} measurements were reused from identical APKs.".format(
+            build_count, len(reused)))
+        for apk_name, test_name, reused_path in sorted(reused):
+            print("  {} {}: reused {}".format(apk_name, test_name, reused_path))
+    return apk_name_to_analysis_paths
 
 
 def fetch_repository(repository_path, remote_name):
@@ -252,39 +640,32 @@ def get_all_commits_in_commits_range(start_commit, end_commit, repository_path):
         cwd=repository_path, capture_output=True, text=True)
 
     if commit_proc.returncode != 0:
-        print(("\n\nSomething went wrong while checking out this commit range: {start}..{end}" +
+        print(("\n\nSomething went wrong while checking out this commit range: {start}..{end} . "
                "The associated error message was:\n\n {error}".format(
-                start=start_commit, end=end_commit, error=commit_proc.stderr.decode('utf-8').strip("\n"))),
+                start=start_commit, end=end_commit, error=commit_proc.stderr.strip("\n"))),
               file=sys.stderr)
 
     return [e for e in commit_proc.stdout.split("\n") if e]
 
 
-def clean_project(repository_path):
-    clean_proc = subprocess.run(["./gradlew", "clean"], cwd=repository_path, capture_output=True)
-
-    if clean_proc.returncode != 0:
-        print(("\n\nSomething went wrong while ./gradlew clean. The associated error message was:"
-               "\n\n {error}".format(error=checkout_proc.stderr.decode('utf-8').strip("\n"))),
-              file=sys.stderr)
-        return
-
-
 def build_apk_for_commit(hash, repository_path, build_type):
+    """Checks out the given commit and builds it. Returns whether the build succeeded."""
     checkout_proc = subprocess.run(["git", "checkout", hash], cwd=repository_path, capture_output=True)
 
     if checkout_proc.returncode != 0:
         print(("\n\nSomething went wrong while checking out this commit: {commit} . The associated error message was:"
                "\n\n {error}".format(commit=hash, error=checkout_proc.stderr.decode('utf-8').strip("\n"))),
               file=sys.stderr)
-        return
+        return False
 
     assemble_proc = subprocess.run(["./gradlew", "assemble"+build_type], cwd=repository_path, capture_output=True)
 
     if assemble_proc.returncode != 0:
         print(("\n\nSomething went wrong while assembling this build: {build} . The associated error message was:"
-               "\n\n {error}".format(build=build_type, error=checkout_proc.stderr.decode('utf-8').strip("\n"))),
+               "\n\n {error}".format(build=build_type, error=assemble_proc.stderr.decode('utf-8').strip("\n"))),
               file=sys.stderr)
+        return False
+    return True
 
 
 def build_apk_path_string(repository_path, build_type, phone_architecture):
@@ -295,7 +676,7 @@ def build_apk_path_string(repository_path, build_type, phone_architecture):
 
 def move_apk_to_cwd(apk_path, commit_hash):
     new_apk_name = "apk_commit_" + commit_hash + ".apk"
-    proc = subprocess.run(["mv", apk_path, new_apk_name])
+    proc = subprocess.run(["mv", apk_path, new_apk_name], capture_output=True)
     if proc.returncode != 0:
         print(("\n\nSomething went wrong while moving the built apk: {apk} . The associated error message was:"
                "\n\n {error}".format(apk=apk_path, error=proc.stderr.decode('utf-8').strip("\n"))),
@@ -303,34 +684,168 @@ def move_apk_to_cwd(apk_path, commit_hash):
     return new_apk_name
 
 
+def get_apk_for_commit(commit, pool, build_type, architecture, tests=None, resume=False, cache=None):
+    """Builds the APK for the given commit in one of the pool's worktrees, unless it already exists or is cached,
+    and returns its metadata or None if it couldn't be built.
+    """
+    new_apk_name = "apk_commit_" + commit + ".apk"
+    apk_for_commit_already_exists = Path(new_apk_name).exists()
+    cache_key = apk_cache.get_commit_key(architecture, build_type, commit)
+
+    if resume and are_all_tests_analyzed(get_apk_name({KEY_NAME: new_apk_name}), tests):
+        print(f'     SKIPED build for commit {commit}, all tests were already analyzed')
+    elif not apk_for_commit_already_exists and cache and cache.get(cache_key, new_apk_name):
+        print(f'     SKIPED build for commit {commit}, using the cached apk')
+    elif not apk_for_commit_already_exists:
+        with pool.acquire() as worktree_path:
+            if not build_apk_for_commit(commit, worktree_path, build_type):
+                return None
+            built_apk_name = build_apk_path_string(worktree_path, build_type, architecture)
+            new_apk_name = move_apk_to_cwd(built_apk_name, commit)
+        if not Path(new_apk_name).exists():
+            return None
+        if cache:
+            cache.put(cache_key, new_apk_name)
+    else:
+        print(f'     SKIPED build for commit {commit}, apk already exists')
+
+    return {
+        KEY_NAME: new_apk_name,
+        KEY_DATETIME: "",
+        KEY_COMMIT: commit,
+        KEY_ARCHITECTURE: architecture}
+
+
 def build_apks_for_commits(
         start_commit=None, end_commit=None, repository_path=None,
-        build_type=None, architecture=None, remote_name=""):
-    apk_metadata_array = []
-
+        build_type=None, architecture=None, remote_name="", tests=None, resume=False, cache=None,
+        lookahead_count=DEFAULT_BUILD_LOOKAHEAD_COUNT, worker_count=DEFAULT_BUILD_WORKER_COUNT,
+        clean_worktrees=False):
+    """Yields the metadata of each commit's APK as soon as it's built while building up to lookahead_count of the
+    following commits in the background, worker_count at a time, so the builds overlap with the measurements.
+    Commits that fail to build are skipped; any other error, e.g. git not being installed, is raised when the
+    failed commit would be yielded. If clean_worktrees is True, each worktree is cleaned before its first build.
+    """
     fetch_repository(repository_path, remote_name)
     array_of_commit_hash = get_all_commits_in_commits_range(start_commit, end_commit, repository_path)
-    clean_project(repository_path)
+    pool = worktree_pool.WorktreePool(repository_path, worker_count,
+                                      clean_args=CLEAN_BUILD_ARGS if clean_worktrees else None)
 
     numer_of_commits = len(array_of_commit_hash)
-    for index, commit in enumerate(array_of_commit_hash):
+
+    def build(indexed_commit):
+        index, commit = indexed_commit
         print(f'##### Trying to build {index+1} of {numer_of_commits} Actual commit {commit} #####')
-        new_apk_name = "apk_commit_" + commit + ".apk"
-        apk_for_commit_already_exists = Path(new_apk_name).exists()
+        apk_metadata = get_apk_for_commit(commit, pool, build_type, architecture, tests, resume, cache)
+        if apk_metadata is None:
+            print(f'##### Skipping commit {commit}: it could not be built #####', file=sys.stderr)
+        return apk_metadata
 
-        if not apk_for_commit_already_exists:
-            build_apk_for_commit(commit, repository_path, build_type)
-            built_apk_name = build_apk_path_string(repository_path, build_type, architecture)
-            new_apk_name = move_apk_to_cwd(built_apk_name, commit)
+    # With several workers, fewer builds ahead than workers would leave workers idle so the lookahead is at least
+    # the worker count. With one, a lookahead of 0 builds each commit only once the previous one is measured.
+    prefetch_count = max(lookahead_count, worker_count) if worker_count > 1 else lookahead_count
+    for apk_metadata in iter_prefetched(build, enumerate(array_of_commit_hash), prefetch_count,
+                                        max_workers=worker_count):
+        if apk_metadata is not None:
+            yield apk_metadata
+
+
+def read_bisect_log(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_bisect_log(path, bisect_log):
+    fileutil.atomic_write_json(path, bisect_log, indent=2)
+
+
+def bisect_commits(package_id, start_commit, end_commit, repository_path, build_type, architecture, remote_name,
+                   test_name, product, serials=None, adaptive=False, resume=False, cache=None,
+                   build_worker_count=DEFAULT_BUILD_WORKER_COUNT, dedupe=False, store=None, run_id=None,
+                   clean_worktrees=False):
+    """Finds the commit in the range after which the median duration changed significantly, assuming there is a
+    single such change, by measuring the endpoints and then bisecting. A change is significant if the bootstrapped
+    confidence interval of the percent change excludes 0: see analyze_durations.compare_stats.
+
+    The stats of each measured commit are logged so an interrupted bisection can be continued with resume.
+    Returns the first commit with the changed duration or None if the endpoints don't differ significantly.
+    """
+    fetch_repository(repository_path, remote_name)
+    # rev-list lists the newest commit first.
+    commits = list(reversed(get_all_commits_in_commits_range(start_commit, end_commit, repository_path)))
+    if len(commits) < 2:
+        raise Exception("Bisecting requires at least two commits in the range: found {}".format(len(commits)))
+    pool = worktree_pool.WorktreePool(repository_path, build_worker_count,
+                                      clean_args=CLEAN_BUILD_ARGS if clean_worktrees else None)
+
+    log_path = os.path.join(BACKFILL_DIR, BISECT_LOG_FILE_TEMPLATE.format(
+        start_commit=commits[0][:12], end_commit=commits[-1][:12], test_name=test_name))
+    if os.path.exists(log_path) and not resume:
+        raise Exception("A bisection log already exists at {}: use --resume to continue it or delete it".format(
+            log_path))
+    bisect_log = read_bisect_log(log_path) if os.path.exists(log_path) else {
+        'test_name': test_name,
+        'commits': commits,
+        'results': {},
+    }
+    results = bisect_log['results']
+
+    def build(commit):
+        apk_metadata = get_apk_for_commit(commit, pool, build_type, architecture, [test_name], resume, cache)
+        if apk_metadata is None:
+            raise Exception("Unable to build commit {}: see the errors above".format(commit))
+        return apk_metadata
+
+    def measure(commit_indices):
+        # Several commits, i.e. the endpoints, are built and measured concurrently if there are several build
+        # workers and devices.
+        commits_to_measure = [commits[i] for i in commit_indices if commits[i] not in results]
+        apk_metadata_array = list(iter_prefetched(build, commits_to_measure, len(commits_to_measure),
+                                                  max_workers=build_worker_count))
+        apk_name_to_analysis_paths = run_performance_analysis_on_nightly(
+            package_id, MEASURE_START_UP_SCRIPT, apk_metadata_array, build_type, [test_name], product, serials,
+            adaptive, resume, dedupe, store, run_id)
+        for commit, apk_metadata in zip(commits_to_measure, apk_metadata_array):
+            # Only this run's analysis, or the one --resume skipped measuring for, is used: an earlier run may have
+            # left a stale analysis of the same build.
+            analysis_path = apk_name_to_analysis_paths.get(get_apk_name(apk_metadata), {}).get(test_name)
+            if not analysis_path:
+                raise Exception("Unable to measure commit {}: see the errors above".format(commit))
+            results[commit] = analyze_durations.load_stats(analysis_path)
+            write_bisect_log(log_path, bisect_log)
+
+    def compare(old_index, new_index):
+        comparison = analyze_durations.compare_stats(results[commits[old_index]], results[commits[new_index]])
+        ci_low, ci_high = comparison['median_percent_change_ci']
+        print("{}..{}: median {:+.1f}% [{:+.1f}%, {:+.1f}%], p={:.3g}: {}".format(
+            commits[old_index][:12], commits[new_index][:12], comparison['median_percent_change'], ci_low, ci_high,
+            comparison['mann_whitney_p_value'], comparison['verdict']))
+        return comparison
+
+    good, bad = 0, len(commits) - 1
+    print("Bisecting {} commits with {}...".format(len(commits), test_name))
+    measure([good, bad])
+    endpoint_verdict = compare(good, bad)['verdict']
+    if endpoint_verdict == analyze_durations.COMPARISON_VERDICT_NO_CHANGE:
+        print("No significant change between the endpoints: there is nothing to bisect.")
+        return None
+
+    while bad - good > 1:
+        mid = (good + bad) // 2
+        print("##### Bisecting: {} commits left, measuring {} #####".format(bad - good - 1, commits[mid]))
+        measure([mid])
+        if compare(good, mid)['verdict'] == endpoint_verdict:
+            bad = mid
         else:
-            print(f'     SKIPED build for commit {commit}, apk already exists')
+            good = mid
+        bisect_log['good'], bisect_log['bad'] = commits[good], commits[bad]
+        write_bisect_log(log_path, bisect_log)
 
-        apk_metadata_array.append({
-            KEY_NAME: new_apk_name,
-            KEY_DATETIME: "",
-            KEY_COMMIT: commit,
-            KEY_ARCHITECTURE: architecture})
-    return apk_metadata_array
+    bisect_log['first_changed_commit'] = commits[bad]
+    write_bisect_log(log_path, bisect_log)
+    print("The {} was introduced by {} (the previous commit is {}). The results are logged to {}.".format(
+        endpoint_verdict, commits[bad], commits[good], log_path))
+    return commits[bad]
 
 
 def cleanup(array_of_apk_path):
@@ -348,31 +863,110 @@ def validate_args(args):
         raise Exception("Provide the path to your fenix repository to run this script with the commits option")
     if args.build_source == BUILD_SRC_COMMITS and not args.startcommit and not args.endcommit:
         raise Exception("Running backfill with commits between two commits requires a start and end commit")
+    if args.bisect and args.build_source != BUILD_SRC_COMMITS:
+        raise Exception("--bisect is only supported with {}".format(BUILD_SRC_COMMITS))
+    if args.prefetch < 0:
+        raise Exception("--prefetch cannot be negative")
+    if args.build_lookahead < 0:
+        raise Exception("--build-lookahead cannot be negative")
+    if args.build_workers < 1:
+        raise Exception("--build-workers must be at least 1")
+    if args.build_lookahead == 0 and args.build_workers > 1:
+        raise Exception("--build-lookahead 0 builds one commit at a time so it can't be used with --build-workers")
 
 
 def main():
     args = parse_args()
     validate_args(args)
 
+    serials = args.devices
+    if not serials:
+        # We check the devices up front so, e.g., a second device plugged in by mistake gives a clear error rather
+        # than one from the first adb command.
+        connected_serials = adb.get_connected_device_serials()
+        if not connected_serials:
+            raise Exception("`adb devices` did not list any ready devices")
+        if not args.all_devices and len(connected_serials) > 1:
+            raise Exception("{} devices are connected ({}): pass --devices to choose the ones to measure on, or "
+                            "--all-devices".format(len(connected_serials), ", ".join(connected_serials)))
+        serials = connected_serials
+    if len(serials) > 1:
+        print("Measuring on devices: {}".format(", ".join(serials)))
+
+    cache = None
+    if not args.no_apk_cache:
+        cache = apk_cache.ApkCache(budget_bytes=args.apk_cache_budget_gb * 1000 ** 3)
+
+    # Each result is committed as soon as it's added so the store needn't be closed, e.g. on errors.
+    Path(BACKFILL_DIR).mkdir(parents=True, exist_ok=True)
+    store = results_store.ResultsStore(RESULTS_STORE_PATH)
+    imported_count = import_legacy_results(store)
+    if imported_count:
+        print("Imported {} existing analyses into {}.".format(imported_count, RESULTS_STORE_PATH))
+    run_id = store.start_run(" ".join(sys.argv))
+
+    if args.bisect:
+        bisect_commits(
+            PROD_TO_CHANNEL_TO_PKGID[args.product][args.release_channel],
+            args.startcommit,
+            args.endcommit,
+            args.repository_to_test_path,
+            args.release_channel,
+            args.architecture,
+            args.git_remote_name if args.git_remote_name else "",
+            args.tests[0],
+            args.product,
+            serials,
+            args.adaptive,
+            args.resume,
+            cache,
+            args.build_workers,
+            not args.no_dedupe,
+            store,
+            run_id,
+            args.clean_worktrees)
+        return
+
     if args.build_source == BUILD_SRC_TASKCLUSTER:
         array_of_dates = get_date_array_for_range(args.startdate, args.enddate)
-        array_of_apk_metadata = download_nightly_for_range(array_of_dates, args.architecture, args.product)
+        apk_metadata_iter = download_nightly_for_range(array_of_dates, args.architecture, args.product, args.tests,
+                                                       args.resume, args.prefetch, args.taskcluster_index_url, cache)
     elif args.build_source == BUILD_SRC_COMMITS:
-        array_of_apk_metadata = build_apks_for_commits(
+        apk_metadata_iter = build_apks_for_commits(
             start_commit=args.startcommit,
             end_commit=args.endcommit,
             repository_path=args.repository_to_test_path,
             build_type=args.release_channel,
             architecture=args.architecture,
-            remote_name=args.git_remote_name if args.git_remote_name else "")
+            remote_name=args.git_remote_name if args.git_remote_name else "",
+            tests=args.tests,
+            resume=args.resume,
+            cache=cache,
+            lookahead_count=args.build_lookahead,
+            worker_count=args.build_workers,
+            clean_worktrees=args.clean_worktrees)
+
+    array_of_apk_metadata = []
+
+    def collect():
+        # The APKs are measured as they are downloaded or built so we collect them here for the cleanup.
+        for apk_metadata in apk_metadata_iter:
+            array_of_apk_metadata.append(apk_metadata)
+            yield apk_metadata
 
     run_performance_analysis_on_nightly(
         PROD_TO_CHANNEL_TO_PKGID[args.product][args.release_channel],
         MEASURE_START_UP_SCRIPT,
-        array_of_apk_metadata,
+        collect(),
         args.release_channel,
         args.tests,
-        args.product)
+        args.product,
+        serials,
+        args.adaptive,
+        args.resume,
+        not args.no_dedupe,
+        store,
+        run_id)
 
     if args.cleanup is True:
         cleanup(array_of_apk_metadata)
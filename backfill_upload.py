@@ -9,14 +9,12 @@ time we run backfill (e.g. when we identify regressions or test the system).
 """
 
 import argparse
-import ast
 import backfill
 from datetime import datetime
 import json
-import os
+import results_store
 import subprocess
 import sys
-import re
 import urllib
 
 PATH_SECRETS = '.backfill_secrets.json'
@@ -41,6 +39,10 @@ TEST_NAME_TO_DASHBOARD_METRIC = {
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--dry-run', action="store_true")
+    parser.add_argument('--startdate', type=lambda date: datetime.strptime(date, backfill.DATETIME_FORMAT),
+                        help="upload results from this date onwards. Format: yyyy.mm.dd")
+    parser.add_argument('--enddate', type=lambda date: datetime.strptime(date, backfill.DATETIME_FORMAT),
+                        help="upload results up to and including this date. Format: yyyy.mm.dd")
     return parser.parse_args()
 
 
@@ -86,23 +88,15 @@ def prompt_for_device(device):
         raise AssertionError(f'Expected value y or n. Got {value}')
 
 
-def find_perf_result_files_to_upload():
-    return [os.path.join(backfill.BACKFILL_DIR, f) for f in os.listdir(backfill.BACKFILL_DIR)
-            if f.endswith('-analysis.txt')]
-
-
-def get_perf_results_to_upload(perf_result_file_paths):
+def get_perf_results_to_upload(store, start_date=None, end_date=None):
     output_results = []
-    for path in perf_result_file_paths:
-        with open(path) as f:
-            perf_result = ast.literal_eval(f.read())
+    for perf_result in store.get_results(start_date, end_date):
+        if not perf_result[results_store.KEY_DATE]:
+            continue  # e.g. a build of a commit, which doesn't appear on the dashboards.
 
         # Append the date to the object so it's easier to upload. Since we only record the date,
         # we set the time to a constant for consistency between uploads.
-        #
-        # Example file name: 0-nightly_2021_09_01-cold_main_first_frame-analyzed.txt
-        date_str = re.search(r'(\d{4}_\d{2}_\d{2})', path).group(1)
-        date = datetime.strptime(date_str + ' 12:00:01', '%Y_%m_%d %H:%M:%S')
+        date = datetime.strptime(perf_result[results_store.KEY_DATE] + ' 12:00:01', '%Y-%m-%d %H:%M:%S')
         perf_result[KEY_TIMESTAMP_DATETIME] = date
         perf_result[KEY_TIMESTAMP_EPOCH] = round(date.timestamp())
         output_results.append(perf_result)
@@ -158,8 +152,12 @@ def main():
     device = get_device()
     prompt_for_device(device)
 
-    perf_result_file_paths = find_perf_result_files_to_upload()
-    perf_results = get_perf_results_to_upload(perf_result_file_paths)
+    # A dry run mustn't change the store so the legacy results are imported into a copy that's discarded.
+    open_store = results_store.ResultsStore.open_scratch_copy if args.dry_run else results_store.ResultsStore
+    with open_store(backfill.RESULTS_STORE_PATH) as store:
+        # The results of backfills run before the store existed are only in files.
+        backfill.import_legacy_results(store)
+        perf_results = get_perf_results_to_upload(store, args.startdate, args.enddate)
     for result in perf_results:
         upload(result, secrets[SECRETS_KEY_AUTH], device, args.dry_run)
 
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import analyze_durations
+import argparse
+import ast
+import datetime
+import io
+import json
+import os
+import random
+import re
+import statistics
+import tempfile
+import timeit
+import tracemalloc
+
+import measure_start_up
+
+DESC = """Micro-benchmarks for the performance-sensitive parts of these scripts.
+
+Each benchmark compares the current implementation against the one it replaced, which
+is kept in this file for reference, over inputs derived from the fixtures in test/.
+"""
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test')
+FIXTURE_NAV_START_LOGCAT = os.path.join(FIXTURE_DIR, 'nav_start_logcat_format.txt')
+FIXTURE_AVERAGE_LOGCAT = os.path.join(FIXTURE_DIR, 'average_times_logcat_format.txt')
+
+BENCH_NAV_START_LOGCAT = 'nav-start-logcat'
+BENCH_TO_STATS = 'to-stats'
+BENCH_ANALYZE_LOGCAT = 'analyze-logcat'
+BENCH_LOAD_STATS = 'load-stats'
+BENCHMARKS = [BENCH_NAV_START_LOGCAT, BENCH_TO_STATS, BENCH_ANALYZE_LOGCAT, BENCH_LOAD_STATS]
+
+DEFAULT_REPEAT = 5
+DEFAULT_SIZE_MB = 5
+DEFAULT_REPLICATE_COUNT = 100000
+
+# A typical backfill result file has this many replicates.
+BACKFILL_REPLICATE_COUNT = 30
+BACKFILL_FILE_COUNT = 1000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=DESC, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("benchmark", choices=BENCHMARKS, help="the benchmark to run")
+    parser.add_argument("-r", "--repeat", default=DEFAULT_REPEAT, type=int,
+                        help="the number of times to run each implementation; the fastest is reported. "
+                             "defaults to {}".format(DEFAULT_REPEAT))
+    parser.add_argument("--size-mb", default=DEFAULT_SIZE_MB, type=float,
+                        help="the approximate size of the generated input. defaults to {}".format(DEFAULT_SIZE_MB))
+    parser.add_argument("--replicate-count", default=DEFAULT_REPLICATE_COUNT, type=int,
+                        help="the number of replicates in the large replicate set. defaults to {}".format(
+                            DEFAULT_REPLICATE_COUNT))
+    return parser.parse_args()
+
+
+def time_best_of(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def print_timing(name, seconds, size_bytes=None, baseline_seconds=None):
+    throughput = ' {:>9.1f} MB/s'.format(size_bytes / seconds / 1e6) if size_bytes else ''
+    speedup = ' ({:.1f}x)'.format(baseline_seconds / seconds) if baseline_seconds else ''
+    print('  {:<24} {:>9.1f} ms{}{}'.format(name, seconds * 1000, throughput, speedup))
+
+
+def measure_peak_memory(fn):
+    """Returns the peak size, in bytes, of the Python allocations made by fn. Memory mapped files aren't included:
+    their pages are managed by the OS, which can evict them, rather than by the Python heap.
+    """
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def generate_replicates(count, seed=0):
+    """Generates start up durations with a long tail, like our real results."""
+    rng = random.Random(seed)
+    return [float(round(rng.lognormvariate(7, 0.1))) for _ in range(count)]
+
+
+def pad_lines(lines, is_marker, size_bytes):
+    """Repeats the non-marker lines in the middle of the given lines until the output is roughly size_bytes. This
+    simulates verbose logging without changing the expected result.
+    """
+    noise = [line for line in lines if not is_marker(line)]
+    noise_size = sum(len(line) for line in noise)
+    repeat_count = max(int(size_bytes / noise_size), 1)
+    middle = len(lines) // 2
+    return lines[:middle] + noise * repeat_count + lines[middle:]
+
+
+def legacy_get_measurement_from_nav_start_logcat(product, pkg_id, logcat_bytes):
+    def line_to_datetime(line):
+        date_str = ' '.join(line.split(' ')[:2])
+        date_str_with_micros = date_str + '000'
+        return datetime.datetime.strptime(date_str_with_micros, '%m-%d %H:%M:%S.%f')
+
+    def get_proc_start_datetime():
+        proc_start_re = re.compile(r'ActivityManager: Start proc \d+:{}/'.format(pkg_id))
+        proc_start_lines = [line for line in lines if proc_start_re.search(line)]
+        assert len(proc_start_lines) == 1
+        return line_to_datetime(proc_start_lines[0])
+
+    def get_page_start_datetime():
+        page_start_re = re.compile('GeckoSession: handleMessage GeckoView:PageStart uri=')
+        page_start_lines = [line for line in lines if page_start_re.search(line)]
+        is_old_version_of_focus = 'about:blank' in page_start_lines[0] and product == measure_start_up.PROD_FOCUS
+        assert len(page_start_lines) == (3 if is_old_version_of_focus else 2)
+        return line_to_datetime(page_start_lines[1])
+
+    logcat = logcat_bytes.decode('UTF-8')
+    lines = logcat.split('\n')
+    elapsed_seconds = (get_page_start_datetime() - get_proc_start_datetime()).total_seconds()
+    return round(elapsed_seconds * 1000)
+
+
+def bench_nav_start_logcat(args):
+    product = measure_start_up.PROD_FENIX
+    pkg_id = measure_start_up.PROD_TO_CHANNEL_TO_PKGID[product]['nightly']
+    markers_re = measure_start_up.get_nav_start_markers_re(pkg_id)
+
+    with open(FIXTURE_NAV_START_LOGCAT, 'rb') as f:
+        lines = f.read().splitlines(keepends=True)
+    logcat = b''.join(pad_lines(lines, markers_re.search, args.size_mb * 1e6))
+
+    expected = legacy_get_measurement_from_nav_start_logcat(product, pkg_id, logcat)
+    actual = measure_start_up.get_measurement_from_nav_start_logcat(product, pkg_id, logcat)
+    assert expected == actual, 'implementations disagree: {} != {}'.format(expected, actual)
+
+    print('Parsing a {:.1f} MB nav start logcat (best of {}):'.format(len(logcat) / 1e6, args.repeat))
+    legacy_seconds = time_best_of(
+        lambda: legacy_get_measurement_from_nav_start_logcat(product, pkg_id, logcat), args.repeat)
+    print_timing('legacy (str, strptime)', legacy_seconds, len(logcat))
+
+    bytes_seconds = time_best_of(
+        lambda: measure_start_up.get_measurement_from_nav_start_logcat(product, pkg_id, logcat), args.repeat)
+    print_timing('single pass (bytes)', bytes_seconds, len(logcat), legacy_seconds)
+
+    logcat_view = memoryview(logcat)
+    view_seconds = time_best_of(
+        lambda: measure_start_up.get_measurement_from_nav_start_logcat(product, pkg_id, logcat_view), args.repeat)
+    print_timing('single pass (memoryview)', view_seconds, len(logcat), legacy_seconds)
+
+
+def legacy_to_stats(measurements_arr):
+    return {
+        'max': max(measurements_arr),
+        'mean': statistics.mean(measurements_arr),
+        'median': statistics.median(measurements_arr),
+        'min': min(measurements_arr),
+        'replicate_count': len(measurements_arr),
+        'replicates': measurements_arr,
+        'stdev': statistics.stdev(measurements_arr),
+    }
+
+
+def bench_to_stats(args):
+    # The current implementation computes more stats than the legacy one: percentiles, IQR, MAD, trimmed mean and CV.
+    replicate_sets = [generate_replicates(BACKFILL_REPLICATE_COUNT, seed) for seed in range(BACKFILL_FILE_COUNT)]
+    print('to_stats over {} sets of {} replicates (best of {}):'.format(
+        BACKFILL_FILE_COUNT, BACKFILL_REPLICATE_COUNT, args.repeat))
+    legacy_seconds = time_best_of(lambda: [legacy_to_stats(r) for r in replicate_sets], args.repeat)
+    print_timing('legacy (statistics)', legacy_seconds)
+    current_seconds = time_best_of(lambda: [analyze_durations.to_stats(r) for r in replicate_sets], args.repeat)
+    print_timing('numpy', current_seconds, baseline_seconds=legacy_seconds)
+
+    replicates = generate_replicates(args.replicate_count)
+    print('to_stats over 1 set of {} replicates (best of {}):'.format(args.replicate_count, args.repeat))
+    legacy_seconds = time_best_of(lambda: legacy_to_stats(replicates), args.repeat)
+    print_timing('legacy (statistics)', legacy_seconds)
+    current_seconds = time_best_of(lambda: analyze_durations.to_stats(replicates), args.repeat)
+    print_timing('numpy', current_seconds, baseline_seconds=legacy_seconds)
+
+
+def legacy_read_from_logcat_path(path):
+    # detect_filetype used to read the whole file, and then the reader read it again, line by line.
+    with open(path) as f:
+        contents = f.read()
+    assert re.match(r'^\d+-\d+', contents)
+
+    measurements = []
+    with open(path) as f:
+        for line in f:
+            message_text = line[line.rfind(': ') + 2:]
+            if message_text and message_text.startswith(analyze_durations.LOGCAT_MATCH_STR):
+                measurements.append(float(message_text[len(analyze_durations.LOGCAT_MATCH_STR):]))
+    return measurements
+
+
+def read_from_logcat_path(path):
+    filetype = analyze_durations.detect_filetype(path)
+    assert filetype is analyze_durations.InputFileType.LOGCAT
+    return filetype.read_from(path)
+
+
+def bench_analyze_logcat(args):
+    with open(FIXTURE_AVERAGE_LOGCAT, 'rb') as f:
+        average_lines = f.read().splitlines(keepends=True)
+    with open(FIXTURE_NAV_START_LOGCAT, 'rb') as f:
+        noise_lines = f.read().splitlines(keepends=True)
+    lines = pad_lines(average_lines + noise_lines, lambda line: b': average ' in line, args.size_mb * 1e6)
+
+    with tempfile.NamedTemporaryFile(suffix='.txt') as f:
+        f.writelines(lines)
+        f.flush()
+        path = f.name
+        size_bytes = os.path.getsize(path)
+
+        expected = legacy_read_from_logcat_path(path)
+        actual = read_from_logcat_path(path)
+        assert expected == actual, 'implementations disagree: {} != {}'.format(expected, actual)
+
+        print('Detecting the type of and parsing a {:.1f} MB average logcat (best of {}):'.format(
+            size_bytes / 1e6, args.repeat))
+        legacy_seconds = time_best_of(lambda: legacy_read_from_logcat_path(path), args.repeat)
+        print_timing('legacy (str, lines)', legacy_seconds, size_bytes)
+        current_seconds = time_best_of(lambda: read_from_logcat_path(path), args.repeat)
+        print_timing('mmap (bytes.find)', current_seconds, size_bytes, legacy_seconds)
+
+        print('Peak Python memory:')
+        print('  {:<24} {:>9.1f} MB'.format(
+            'legacy (str, lines)', measure_peak_memory(lambda: legacy_read_from_logcat_path(path)) / 1e6))
+        print('  {:<24} {:>9.1f} MB'.format(
+            'mmap (bytes.find)', measure_peak_memory(lambda: read_from_logcat_path(path)) / 1e6))
+
+
+def bench_load_stats(args):
+    # Like backfill_upload.py loading a backfill_output directory.
+    all_stats = [analyze_durations.to_stats(generate_replicates(BACKFILL_REPLICATE_COUNT, seed))
+                 for seed in range(BACKFILL_FILE_COUNT)]
+    legacy_outputs = []
+    for stats in all_stats:
+        output = io.StringIO()
+        analyze_durations.print_stats(stats, output)
+        legacy_outputs.append(output.getvalue().encode('utf-8'))
+    json_outputs = [(json.dumps(stats, sort_keys=True) + '\n').encode('utf-8') for stats in all_stats]
+    size_bytes = sum(len(output) for output in json_outputs)
+
+    assert [analyze_durations.parse_stats(output) for output in json_outputs] == all_stats
+    assert [analyze_durations.parse_stats(output) for output in legacy_outputs] == all_stats
+
+    print('Loading {} results of {} replicates (best of {}):'.format(
+        BACKFILL_FILE_COUNT, BACKFILL_REPLICATE_COUNT, args.repeat))
+    legacy_seconds = time_best_of(
+        lambda: [ast.literal_eval(output.decode('utf-8')) for output in legacy_outputs], args.repeat)
+    print_timing('legacy (literal_eval)', legacy_seconds, size_bytes)
+    current_seconds = time_best_of(
+        lambda: [analyze_durations.parse_stats(output) for output in json_outputs], args.repeat)
+    print_timing('json', current_seconds, size_bytes, legacy_seconds)
+
+
+def main():
+    args = parse_args()
+    if args.benchmark == BENCH_NAV_START_LOGCAT:
+        bench_nav_start_logcat(args)
+    elif args.benchmark == BENCH_TO_STATS:
+        bench_to_stats(args)
+    elif args.benchmark == BENCH_ANALYZE_LOGCAT:
+        bench_analyze_logcat(args)
+    elif args.benchmark == BENCH_LOAD_STATS:
+        bench_load_stats(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Helpers shared by the tools that keep state on disk."""
+
+import json
+import os
+
+# The tools' caches, e.g. of analyses, APKs and worktrees, are kept in subdirectories of this directory. It's in the
+# user's cache directory, rather than the working directory, so runs from anywhere share the caches and they aren't
+# left in, e.g., the checkout of the app being measured. It can be overridden with the PERF_TOOLS_CACHE_DIR
+# environment variable.
+CACHE_DIR = os.environ.get('PERF_TOOLS_CACHE_DIR') or os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'perf-tools')
+
+
+def atomic_write_json(path, obj, **dump_kwargs):
+    """Writes obj as JSON to path, creating its directory if needed. We write to a temporary file and rename it,
+    which is atomic, so an interrupted run can't leave a partially written file and concurrent writers, e.g. several
+    processes, don't see each other's partial writes. dump_kwargs are passed to json.dump, e.g. indent=2.
+    """
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, **dump_kwargs)
+    os.replace(tmp_path, path)
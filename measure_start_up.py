@@ -3,13 +3,19 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import analyze_durations
 import argparse
-import datetime
+import functools
+import json
 import os
+import queue
 import re
-import subprocess
 import time
 
+import perfmath
+import thermal
+from adb import AdbShell, LogcatTail, get_pid, is_process_running, poll_until
+
 DESC = """Measures start up durations using multiple methodologies.
 
 IMPORTANT: each methodology provides a different picture of start up. If you're
@@ -23,6 +29,19 @@ we try to keep this simple and avoid implementing all the things they do.
 
 DEFAULT_ITER_COUNT = 25
 
+# Defaults for --adaptive. The target is the width of the 95% confidence interval of the median as a percentage of
+# the median.
+DEFAULT_MIN_ITER_COUNT = 10
+DEFAULT_MAX_ITER_COUNT = 50
+DEFAULT_TARGET_CI_WIDTH_PERCENT = 2.0
+
+# The nav start measurement waits until ScriptPreloader::CacheWriteComplete is logged. This can take up to
+# 14s from proc start on a Moto G5, as of Feb 11 2022, so this leaves plenty of margin.
+DEFAULT_LOGCAT_TIMEOUT_SECONDS = 30
+
+# The process usually exits within a few hundred milliseconds of a force-stop.
+FORCE_STOP_TIMEOUT_SECONDS = 5
+
 PROD_FENIX = 'fenix'
 PROD_FOCUS = 'focus'
 PRODUCTS = [PROD_FENIX, PROD_FOCUS]
@@ -70,7 +89,8 @@ See https://wiki.mozilla.org/Performance/Fenix#Terminology for descriptions of c
             cold_main_ff=TEST_COLD_MAIN_FF, cold_main_restore=TEST_COLD_MAIN_RESTORE,
             cold_view_ff=TEST_COLD_VIEW_FF, cold_view_nav_start=TEST_COLD_VIEW_NAV_START,
         ))
-    parser.add_argument("path", help="the path to save the measurement results; will abort if file exists")
+    parser.add_argument("path", help=("the path to save the measurement results, as one JSON object per line for each "
+                                      "iteration, written as the iterations complete; will abort if file exists"))
 
     # We ordinarily wouldn't specify a default because it may cause the user to get results
     # from a product they didn't intend but this script lives in the fenix repo so having fenix
@@ -80,70 +100,124 @@ See https://wiki.mozilla.org/Performance/Fenix#Terminology for descriptions of c
 
     parser.add_argument("-c", "--iter-count", default=DEFAULT_ITER_COUNT, type=int,
                         help="the number of iterations to run. defaults to {}".format(DEFAULT_ITER_COUNT))
+    parser.add_argument("--adaptive", action="store_true",
+                        help=("rather than running --iter-count iterations, keep iterating until the 95%% confidence "
+                              "interval of the median is narrower than --target-ci-width"))
+    parser.add_argument("--min-iter-count", default=DEFAULT_MIN_ITER_COUNT, type=int,
+                        help="with --adaptive, the minimum number of iterations. defaults to {}".format(
+                            DEFAULT_MIN_ITER_COUNT))
+    parser.add_argument("--max-iter-count", default=DEFAULT_MAX_ITER_COUNT, type=int,
+                        help="with --adaptive, the maximum number of iterations. defaults to {}".format(
+                            DEFAULT_MAX_ITER_COUNT))
+    parser.add_argument("--target-ci-width", default=DEFAULT_TARGET_CI_WIDTH_PERCENT, type=float,
+                        help=("with --adaptive, the target width of the confidence interval of the median, as a "
+                              "percentage of the median. defaults to {}".format(DEFAULT_TARGET_CI_WIDTH_PERCENT)))
+    parser.add_argument("--cool-down-temp", type=float,
+                        help=("before each iteration, wait until the hottest thermal zone on the device is at most "
+                              "this many degrees Celsius and the CPU frequency isn't limited more than at the start "
+                              "of the run. The thermal state is always recorded with each iteration, regardless of "
+                              "this argument"))
+    parser.add_argument("--cool-down-timeout", default=thermal.DEFAULT_COOL_DOWN_TIMEOUT_SECONDS, type=float,
+                        help=("with --cool-down-temp, the maximum number of seconds to wait before each iteration. "
+                              "defaults to {}".format(thermal.DEFAULT_COOL_DOWN_TIMEOUT_SECONDS)))
+    parser.add_argument("-s", "--serial",
+                        help="the serial of the device to measure on, as listed by `adb devices`. Required if more "
+                             "than one device is connected")
     parser.add_argument("-f", "--force", action="store_true",
                         help="overwrite the given path rather than stopping on file existence")
-
+    parser.add_argument("--resume", action="store_true",
+                        help=("if the given path exists, continue from the last iteration recorded in it, e.g. after "
+                              "adb disconnected. The warm up run is repeated"))
+
+    parser.add_argument("--component",
+                        help=("the activity component to launch, e.g. org.mozilla.fenix/.App, as resolved for the "
+                              "test's intent by a previous run of the same APK. By default, it's resolved on the "
+                              "device"))
     parser.add_argument("--no-startup-cache", action="store_true",
                         help="skips delay in the warm up run to ensure the start up cache is filled")
+    parser.add_argument("--logcat-timeout", default=DEFAULT_LOGCAT_TIMEOUT_SECONDS, type=float,
+                        help=("for logcat-based tests, the maximum number of seconds to wait for the expected lines "
+                              "before failing. defaults to {}".format(DEFAULT_LOGCAT_TIMEOUT_SECONDS)))
+    parser.add_argument("--print-adb-timings", action="store_true",
+                        help="prints how long each adb command took, to help identify harness overhead")
 
     return parser.parse_args()
 
 
 def validate_args(args):
+    if args.force and args.resume:
+        raise Exception("--force and --resume cannot be used together.")
+
     # This helps prevent us from accidentally overwriting previous measurements.
-    if not args.force:
+    if not args.force and not args.resume:
         if os.path.exists(args.path):
             raise Exception("Given `path` unexpectedly exists: pick a new path or use --force to overwrite.")
 
-
-def get_adb_shell_args():
-    return ['adb', 'shell']
+    if args.adaptive and not 2 <= args.min_iter_count <= args.max_iter_count:
+        raise Exception("--min-iter-count must be at least 2 and no greater than --max-iter-count.")
 
 
+# Commands are run on the device through an AdbShell so these args exclude the `adb shell` prefix.
 def get_activity_manager_args():
-    return get_adb_shell_args() + ['am']
+    return ['am']
 
 
-def force_stop(pkg_id):
+def force_stop(shell, pkg_id):
     args = get_activity_manager_args() + ['force-stop', pkg_id]
-    subprocess.run(args, check=True)
+    shell.run(args, check=True)
+
+    # force-stop returns before the process is gone. If we start the app before then, it'd be a warm start.
+    if not poll_until(lambda: not is_process_running(pkg_id, shell), FORCE_STOP_TIMEOUT_SECONDS):
+        raise Exception('{} was still running {}s after force-stop'.format(pkg_id, FORCE_STOP_TIMEOUT_SECONDS))
 
 
-def disable_startup_profiling():
+def disable_startup_profiling(shell):
     # Startup profiling sets the app to the "debug-app" which executes extra code to
     # read a config file off disk that triggers the profiling. Removing the app as a
     # debug app should address that issue but isn't a perfect clean up.
     args = get_activity_manager_args() + ['clear-debug-app']
-    subprocess.run(args, check=True)
+    shell.run(args, check=True)
 
 
-def get_component_name_for_intent(pkg_id, intent):
-    resolve_component_args = (get_adb_shell_args()
-                              + ['cmd', 'package', 'resolve-activity', '--brief']
-                              + intent + [pkg_id])
-    proc = subprocess.run(resolve_component_args, capture_output=True)
-    stdout = proc.stdout.splitlines()
-    assert len(stdout) == 2, 'expected 2 lines. Got: {}'.format(stdout)
-    return stdout[1]
+def get_resolve_activity_args(pkg_id, intent):
+    return ['cmd', 'package', 'resolve-activity', '--brief'] + intent + [pkg_id]
 
 
-def get_start_cmd(test_name, pkg_id, product):
+def parse_resolved_component_name(stdout):
+    """Returns the component name from the output of get_resolve_activity_args or None if it wasn't resolved."""
+    lines = stdout.splitlines()
+    return lines[1].decode('utf-8') if len(lines) == 2 else None
+
+
+def get_component_name_for_intent(shell, pkg_id, intent):
+    proc = shell.run(get_resolve_activity_args(pkg_id, intent))
+    component_name = parse_resolved_component_name(proc.stdout)
+    assert component_name, 'expected 2 lines. Got: {}'.format(proc.stdout.splitlines())
+    return component_name
+
+
+def get_intent_for_test(test_name):
     intent_action_prefix = 'android.intent.action.{}'
     if test_name in [TEST_COLD_MAIN_FF, TEST_COLD_MAIN_RESTORE]:
-        intent = [
+        return [
             '-a', intent_action_prefix.format('MAIN'),
             '-c', 'android.intent.category.LAUNCHER',
         ]
     elif test_name in [TEST_COLD_VIEW_FF, TEST_COLD_VIEW_NAV_START]:
-        intent = [
+        return [
             '-a', intent_action_prefix.format('VIEW'),
             '-d', TEST_URI
         ]
 
+
+def get_start_cmd(shell, test_name, pkg_id, product, component_name=None):
+    intent = get_intent_for_test(test_name)
+
     # You can't launch an app without an pkg_id/activity pair. Instead of
     # hard-coding the activity, which could break on app updates, we ask the
-    # system to resolve it for us.
-    component_name = get_component_name_for_intent(pkg_id, intent)
+    # system to resolve it for us unless the caller, e.g. backfill.py, already knows it for this APK.
+    if not component_name:
+        component_name = get_component_name_for_intent(shell, pkg_id, intent)
     cmd = get_activity_manager_args() + [
         'start-activity',  # this would change to `start` on older API levels like GS5.
         '-W',  # wait for app launch to complete before returning
@@ -160,52 +234,191 @@ def get_start_cmd(test_name, pkg_id, product):
     return cmd
 
 
-def measure(test_name, product, pkg_id, start_cmd_args, iter_count, warmup_delay_seconds):
+def is_median_precise_enough(measurements, min_iter_count, target_ci_width_percent):
+    """A sequential stopping rule for --adaptive: returns True when the confidence interval of the median
+    of the measurements so far is narrower than the target.
+    """
+    if len(measurements) < min_iter_count:
+        return False
+
+    stats = analyze_durations.to_stats(measurements)
+    low, high = perfmath.median_confidence_interval(stats['replicates'])
+    ci_width_percent = (high - low) / stats['median'] * 100
+    if ci_width_percent > target_ci_width_percent:
+        return False
+
+    print('Stopping after {} iterations: the median CI width is {:.2f}% (target {}%)'.format(
+        stats['replicate_count'], ci_width_percent, target_ci_width_percent))
+    return True
+
+
+def measure(shell, test_name, product, pkg_id, start_cmd_args, iter_count, warmup_delay_seconds,
+            logcat_timeout_seconds=DEFAULT_LOGCAT_TIMEOUT_SECONDS, is_precise_enough=None,
+            wait_for_startup_cache=False, on_measurement=None, previous_measurements=None, cool_down_temp_c=None,
+            cool_down_timeout_seconds=thermal.DEFAULT_COOL_DOWN_TIMEOUT_SECONDS):
+    """Measures start up iter_count times. If is_precise_enough is given, it's called with the measurements
+    after each iteration and iterating stops early when it returns True. If on_measurement is given, it's called
+    with the record of each iteration (see create_measurement_record) as soon as the iteration completes.
+    previous_measurements, from an interrupted run, count towards iter_count and is_precise_enough.
+
+    If cool_down_temp_c is given, each iteration waits for the device to cool down before starting: back-to-back
+    cold starts heat the device and throttling adds noise to the results.
+
+    If wait_for_startup_cache is True, the warm up run ends as soon as the app's main process logs that the start up
+    cache is written, waiting at most warmup_delay_seconds. Otherwise, it always lasts warmup_delay_seconds.
+    """
     # Startup profiling may accidentally be left enabled and throw off the results.
     # To prevent this, we disable it.
-    disable_startup_profiling()
+    disable_startup_profiling(shell)
+
+    # Some CPUs' maximum frequency is always limited so throttling is detected relative to the start of the run,
+    # before the cold starts heat the device.
+    baseline_max_freqs_khz = thermal.sample_thermal_state(shell)[thermal.KEY_CPU_MAX_FREQ_KHZ]
 
     # After an (re)installation, we've observed the app starts up more slowly than subsequent runs.
     # As such, we start it once beforehand to let it settle.
-    force_stop(pkg_id)
-    subprocess.run(start_cmd_args, check=True, capture_output=True)  # capture_output so no print to stdout.
-    time.sleep(warmup_delay_seconds)
-
-    measurements = []
-    for _ in range(0, iter_count):
-        force_stop(pkg_id)
-        time.sleep(1)
+    force_stop(shell, pkg_id)
+    if wait_for_startup_cache:
+        shell.run(['logcat', '-c'], check=True)  # So we don't see the cache written by a previous run.
+    shell.run(start_cmd_args, check=True)
+    # Only the main process's cache write tells us its cache is populated. If we can't identify the main process,
+    # we wait the whole delay.
+    main_pid = get_pid(pkg_id, shell) if wait_for_startup_cache else None
+    if main_pid is None:
+        time.sleep(warmup_delay_seconds)
+    elif not wait_for_startup_cache_write(shell.serial, warmup_delay_seconds, main_pid):
+        print('WARNING: {} was not logged by the main process, pid {}, during the {}s warm up: continuing '
+              'anyway.'.format(NavStartLogcatParser.CACHE_WRITE_COMPLETE_STR, main_pid, warmup_delay_seconds))
+
+    device_serial = get_device_serial(shell)
+    measurements = list(previous_measurements or [])
+    for iteration in range(len(measurements), iter_count):
+        force_stop(shell, pkg_id)
+
+        if cool_down_temp_c is not None:
+            thermal_state = thermal.wait_for_cool_down(shell, cool_down_temp_c, cool_down_timeout_seconds,
+                                                       baseline_max_freqs_khz)
+        else:
+            thermal_state = thermal.sample_thermal_state(shell, baseline_max_freqs_khz)
 
         # This is only necessary for nav start tests (to ensure logcat only contains the result from the current run).
         # However, it's not known to be disruptive to other tests (to first frame) so we leave it in.
-        subprocess.run(['adb', 'logcat', '-c'], check=True)
+        shell.run(['logcat', '-c'], check=True)
+
+        wall_clock_time = time.time()
+        am_start_start = time.monotonic()
+        proc = shell.run(start_cmd_args, check=True)  # expected to wait for app to start.
+        am_start_round_trip_millis = (time.monotonic() - am_start_start) * 1000
 
-        proc = subprocess.run(start_cmd_args, check=True, capture_output=True)  # expected to wait for app to start.
-        measurements.append(get_measurement(test_name, product, pkg_id, proc.stdout))
+        measurement = get_measurement(shell, test_name, product, pkg_id, proc.stdout, logcat_timeout_seconds)
+        measurements.append(measurement)
+        if on_measurement:
+            on_measurement(create_measurement_record(iteration, wall_clock_time, measurement, proc.stdout,
+                                                     am_start_round_trip_millis, device_serial, thermal_state))
+
+        if is_precise_enough and is_precise_enough(measurements):
+            break
 
     return measurements
 
 
-def get_measurement(test_name, product, pkg_id, stdout):
+def wait_for_startup_cache_write(serial, timeout_seconds, pid):
+    """Returns True as soon as the process with the given pid logs that its start up cache is written or False if it
+    doesn't within timeout_seconds. Other processes, e.g. the content processes, log their own cache writes, which
+    say nothing about this process's cache, so they're ignored.
+    """
+    marker = NavStartLogcatParser.CACHE_WRITE_COMPLETE_STR.encode('utf-8')
+    deadline = time.monotonic() + timeout_seconds
+    with LogcatTail(serial) as logcat:
+        while True:
+            try:
+                line = logcat.readline(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                return False
+            if line is None:
+                return False
+            if marker in line and get_logcat_line_pid(line) == pid:
+                return True
+
+
+def get_measurement(shell, test_name, product, pkg_id, stdout, logcat_timeout_seconds=DEFAULT_LOGCAT_TIMEOUT_SECONDS):
     if test_name in [TEST_COLD_MAIN_FF, TEST_COLD_VIEW_FF]:
         measurement = get_measurement_from_am_start_log(stdout)
     elif test_name in [TEST_COLD_VIEW_NAV_START, TEST_COLD_MAIN_RESTORE]:
-        # We must sleep until:
-        # - the Navigation::Start event occurs. If we don't, the script will fail.
-        # - the content process start up scripts are cached. If we don't, the cache won't be populated and we won't be
-        # measuring perf accurately. This can take up to 14s from proc start until ScriptPreloader::CacheWriteComplete
-        # is called on a Moto G5, as of Feb 11 2022. There is an explicit 10s sleep in the code:
-        # https://searchfox.org/mozilla-central/rev/fc4d4a8d01b0e50d20c238acbb1739ccab317ebc/js/xpconnect/loader/ScriptPreloader.cpp#769).
-        time.sleep(17)
-        proc = subprocess.run(['adb', 'logcat', '-d'], check=True, capture_output=True)
-        measurement = get_measurement_from_nav_start_logcat(product, pkg_id, proc.stdout)
+        measurement = get_measurement_from_streaming_logcat(shell.serial, product, pkg_id, logcat_timeout_seconds)
     return measurement
 
 
+def get_measurement_from_streaming_logcat(serial, product, pkg_id, timeout_seconds):
+    # We must wait until:
+    # - the Navigation::Start event occurs. If we don't, the script will fail.
+    # - the content process start up scripts are cached. If we don't, the cache won't be populated and we won't be
+    # measuring perf accurately. There is an explicit 10s sleep in the code before the cache is written:
+    # https://searchfox.org/mozilla-central/rev/fc4d4a8d01b0e50d20c238acbb1739ccab317ebc/js/xpconnect/loader/ScriptPreloader.cpp#769).
+    #
+    # Rather than sleeping for a fixed duration, we return as soon as we've seen both in logcat. An unexpected extra
+    # PageStart line before then fails the measurement, like it would if we read the whole log.
+    parser = NavStartLogcatParser(product, pkg_id)
+    deadline = time.monotonic() + timeout_seconds
+    with LogcatTail(serial) as logcat:
+        while not parser.is_complete() and not parser.has_unexpected_page_start_lines():
+            try:
+                line = logcat.readline(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                line = None
+            if line is None:
+                raise TimeoutError('Did not find the expected logcat lines within {}s. Found: {}'.format(
+                    timeout_seconds, parser.describe_progress()))
+            parser.feed(line)
+    return parser.get_measurement()
+
+
+def get_device_serial(shell):
+    return shell.serial or shell.run(['getprop', 'ro.serialno'], check=True).stdout.decode('utf-8').strip()
+
+
+def parse_am_start_log(stdout):
+    """Returns the `key: value` lines of `am start -W` output (see get_measurement_from_am_start_log) as a dict."""
+    fields = {}
+    for line in stdout.decode('utf-8', errors='replace').splitlines():
+        key, separator, value = line.partition(': ')
+        if separator:
+            fields[key.strip()] = value.strip()
+    return fields
+
+
+def create_measurement_record(iteration, wall_clock_time, measurement, am_start_stdout, am_start_round_trip_millis,
+                              device_serial, thermal_state):
+    """Returns the result of a single iteration, with the context needed to interpret it, as a JSON-serializable
+    dict. Fields that are unavailable, e.g. LaunchState on older versions of Android, are None.
+    """
+    def get_int_field(key):
+        value = am_start_fields.get(key)
+        return int(value) if value is not None else None
+
+    am_start_fields = parse_am_start_log(am_start_stdout)
+    wait_time = get_int_field('WaitTime')
+    return {
+        'iteration': iteration,
+        'wall_clock_time': wall_clock_time,  # seconds since the epoch, when the app was started.
+        analyze_durations.MEASUREMENT_RECORD_KEY_DURATION: measurement,
+        'this_time': get_int_field('ThisTime'),
+        'total_time': get_int_field('TotalTime'),
+        'wait_time': wait_time,
+        'launch_state': am_start_fields.get('LaunchState'),
+        # The time spent outside of the system's measurement, e.g. in adb, when starting the app.
+        'harness_overhead_ms': round(am_start_round_trip_millis - wait_time) if wait_time is not None else None,
+        'device_serial': device_serial,
+        # The state before the app was started: see thermal.sample_thermal_state.
+        analyze_durations.MEASUREMENT_RECORD_KEY_THERMAL: thermal_state,
+    }
+
+
 def get_measurement_from_am_start_log(stdout):
     # Sample output:
     # Starting: Intent { cmp=org.mozilla.fenix/.App }
     # Status: ok
+    # LaunchState: COLD
     # Activity: org.mozilla.fenix/.App
     # ThisTime: 5662
     # TotalTime: 5662
@@ -221,62 +434,171 @@ def get_measurement_from_am_start_log(stdout):
     return duration
 
 
-def get_measurement_from_nav_start_logcat(product, pkg_id, logcat_bytes):
+# A logcat timestamp, in the default threadtime format, is at the start of each line: e.g. "05-18 14:32:47.366".
+LOGCAT_TIMESTAMP_LEN = len('05-18 14:32:47.366')
+_DAYS_BEFORE_MONTH = [0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334]
+_NEWLINE = ord('\n')
+
+
+def get_logcat_line_pid(line):
+    """Returns the pid of the process that logged the line, in the default threadtime format, or None."""
+    fields = line[LOGCAT_TIMESTAMP_LEN:].split(None, 1)
+    return int(fields[0]) if fields and fields[0].isdigit() else None
+
+
+def logcat_timestamp_to_millis(timestamp):
+    """Converts a logcat timestamp, as bytes, to milliseconds since the start of the year.
+
+    This relies on the fixed offsets of the fields, which is much faster than strptime. Like
+    strptime without a year, it assumes a non-leap year.
+    """
+    month = int(timestamp[0:2])
+    day = int(timestamp[3:5])
+    hours = int(timestamp[6:8])
+    minutes = int(timestamp[9:11])
+    seconds = int(timestamp[12:14])
+    millis = int(timestamp[15:18])
+    days = _DAYS_BEFORE_MONTH[month - 1] + day - 1
+    return (((days * 24 + hours) * 60 + minutes) * 60 + seconds) * 1000 + millis
+
+
+@functools.lru_cache()
+def get_nav_start_markers_re(pkg_id):
     # Relevant lines:
     # 05-18 14:32:47.366  1759  6003 I ActivityManager: START u0 {act=android.intent.action.VIEW dat=https://example.com/... typ=text/html flg=0x10000000 cmp=org.mozilla.fenix/.IntentReceiverActivity} from uid 2000  # noqa
     # 05-18 14:32:47.402  1759  6003 I ActivityManager: Start proc 9007:org.mozilla.fenix/u0a170 for activity org.mozilla.fenix/.IntentReceiverActivity  # noqa
     # 05-18 14:32:50.809  9007  9007 I GeckoSession: handleMessage GeckoView:PageStart uri=
     # 05-18 14:32:50.821  9007  9007 I GeckoSession: handleMessage GeckoView:PageStop uri=null
-    def line_to_datetime(line):
-        date_str = ' '.join(line.split(' ')[:2])  # e.g. "05-18 14:32:47.366"
-        # strptime needs microseconds. logcat outputs millis so we append zeroes
-        date_str_with_micros = date_str + '000'
-        return datetime.datetime.strptime(date_str_with_micros, '%m-%d %H:%M:%S.%f')
-
-    def get_proc_start_datetime():
-        # This regex may not work on older versions of Android: we don't care
-        # yet because supporting older versions isn't in our requirements.
-        proc_start_re = re.compile(r'ActivityManager: Start proc \d+:{}/'.format(pkg_id))
-        proc_start_lines = [line for line in lines if proc_start_re.search(line)]
-        assert len(proc_start_lines) == 1
-        return line_to_datetime(proc_start_lines[0])
-
-    def get_page_start_datetime():
-        page_start_re = re.compile('GeckoSession: handleMessage GeckoView:PageStart uri=')
-        page_start_lines = [line for line in lines if page_start_re.search(line)]
-        page_start_line_count = len(page_start_lines)
-        page_start_assert_msg = 'found len=' + str(page_start_line_count)
+    #
+    # The proc start regex may not work on older versions of Android: we don't care
+    # yet because supporting older versions isn't in our requirements.
+    #
+    # Every marker contains an "S" so the pattern starts with that literal, which lets the regex engine
+    # use its fast literal search to skip to candidates, and the lookbehinds check the preceding text.
+    return re.compile(
+        rb'S(?:(?<=ActivityManager: S)(?P<proc_start>tart proc \d+:' + re.escape(pkg_id.encode('utf-8')) + rb'/)|'
+        rb'(?<=GeckoSession: handleMessage GeckoView:PageS)(?P<page_start>tart uri=)(?P<uri>[^\n]*)|'
+        rb'(?P<cache_write_complete>criptPreloader::CacheWriteComplete))'
+    )
+
 
+class NavStartLogcatParser:
+    """Finds the lines needed for nav start measurements. Lines can be fed incrementally, so we can stop
+    reading logcat as soon as we have them, or a complete dump can be scanned in a single pass.
+    """
+
+    CACHE_WRITE_COMPLETE_STR = 'ScriptPreloader::CacheWriteComplete'
+
+    def __init__(self, product, pkg_id):
+        self.product = product
+        self.markers_re = get_nav_start_markers_re(pkg_id)
+
+        self.proc_start_millis = []
+        self.page_start_millis = []
+        self.page_start_uris = []
+        self.is_cache_write_complete = False
+
+    def feed(self, line):
+        """Feeds a single logcat line, as bytes."""
+        match = self.markers_re.search(line)
+        if match:
+            self._on_match(match, line[:LOGCAT_TIMESTAMP_LEN])
+
+    def feed_buffer(self, logcat):
+        """Feeds a complete logcat dump, as bytes or a memoryview, without splitting it into lines."""
+        for match in self.markers_re.finditer(logcat):
+            # There are only a handful of matches so walking back to the start of the line is cheap.
+            line_start = match.start()
+            while line_start > 0 and logcat[line_start - 1] != _NEWLINE:
+                line_start -= 1
+            self._on_match(match, bytes(logcat[line_start:line_start + LOGCAT_TIMESTAMP_LEN]))
+
+    def _on_match(self, match, timestamp):
+        if match.group('proc_start'):
+            self.proc_start_millis.append(logcat_timestamp_to_millis(timestamp))
+        elif match.group('page_start'):
+            self.page_start_millis.append(logcat_timestamp_to_millis(timestamp))
+            self.page_start_uris.append(match.group('uri'))
+        else:
+            self.is_cache_write_complete = True
+
+    def get_expected_page_start_line_count(self):
         # In focus versions <= v8.8.2, it logs 3 PageStart lines and these include actual uris.
         # We need to handle our assertion differently due to the different line count.
         #
         # In focus versions >= v8.8.3, this measurement is broken because the logcat were removed.
-        is_old_version_of_focus = 'about:blank' in page_start_lines[0] and product == PROD_FOCUS
+        is_old_version_of_focus = b'about:blank' in self.page_start_uris[0] and self.product == PROD_FOCUS
         if is_old_version_of_focus:
-            assert page_start_line_count == 3, page_start_assert_msg  # Lines: about:blank, target URL, target URL.
+            return 3  # Lines: about:blank, target URL, target URL.
         else:
-            assert page_start_line_count == 2, page_start_assert_msg  # Lines: about:blank, target URL.
-        return line_to_datetime(page_start_lines[1])  # 2nd PageStart is for target URL.
+            return 2  # Lines: about:blank, target URL.
 
-    logcat = logcat_bytes.decode('UTF-8')  # Easier to work with and must for strptime.
-    lines = logcat.split('\n')
+    def is_complete(self):
+        return (len(self.proc_start_millis) > 0 and
+                len(self.page_start_millis) > 0 and
+                len(self.page_start_millis) == self.get_expected_page_start_line_count() and
+                self.is_cache_write_complete)
 
-    # We measure the time from process start, rather than the earlier START
-    # activity line, because I assume we have no control over the duration
-    # before our process starts. If we wanted to put in more time, we could
-    # double-check this assumption by seeing what values `am start -W` returns
-    # compared to the time stamps.
-    #
-    # For total_seconds(), values < 1s are expressed in decimal (e.g. .001 is 1ms).
-    elapsed_seconds = (get_page_start_datetime() - get_proc_start_datetime()).total_seconds()
-    elapsed_millis = round(elapsed_seconds * 1000)
-    return elapsed_millis
+    def has_unexpected_page_start_lines(self):
+        """Returns True if more PageStart lines were found than expected, in which case get_measurement fails."""
+        return (len(self.page_start_millis) > 0 and
+                len(self.page_start_millis) > self.get_expected_page_start_line_count())
 
+    def describe_progress(self):
+        return 'proc start lines={}, PageStart lines={}, {} seen={}'.format(
+            len(self.proc_start_millis), len(self.page_start_millis), self.CACHE_WRITE_COMPLETE_STR,
+            self.is_cache_write_complete)
 
-def save_measurements(path, measurements):
-    with open(path, 'w') as f:
-        for measurement in measurements:
-            f.write(str(measurement) + '\n')
+    def get_measurement(self):
+        assert len(self.proc_start_millis) == 1
+
+        page_start_line_count = len(self.page_start_millis)
+        page_start_assert_msg = 'found len=' + str(page_start_line_count)
+        assert page_start_line_count > 0, page_start_assert_msg
+        assert page_start_line_count == self.get_expected_page_start_line_count(), page_start_assert_msg
+
+        # We measure the time from process start, rather than the earlier START
+        # activity line, because I assume we have no control over the duration
+        # before our process starts. If we wanted to put in more time, we could
+        # double-check this assumption by seeing what values `am start -W` returns
+        # compared to the time stamps.
+        return self.page_start_millis[1] - self.proc_start_millis[0]  # 2nd PageStart is for target URL.
+
+
+def get_measurement_from_nav_start_logcat(product, pkg_id, logcat_bytes):
+    parser = NavStartLogcatParser(product, pkg_id)
+    parser.feed_buffer(logcat_bytes)
+    return parser.get_measurement()
+
+
+def create_measurement_records_file(path):
+    open(path, 'w').close()
+
+
+def read_measurement_records_to_resume(path):
+    """Returns the records written by an interrupted run. If we crashed while writing the last record, it's
+    removed from the file so that new records can be appended.
+    """
+    with open(path) as f:
+        lines = [line for line in f if line.strip()]
+
+    records = []
+    for index, line in enumerate(lines):
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            if index != len(lines) - 1:
+                raise
+            print('WARNING: discarding the partially written last record of {}'.format(path))
+            with open(path, 'w') as f:
+                f.writelines(lines[:-1])
+    return records
+
+
+def append_measurement_record(path, record):
+    # We reopen the file for each record so that everything measured so far is on disk if we crash.
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
 
 
 def print_preface_text(test_name):
@@ -295,8 +617,9 @@ def get_warmup_delay_seconds(no_startup_cache):
     # We've been told the start up cache is populated ~60s after first start up. As such, it's likely
     # most users start the app with it so, if we want to measure the representative user experience,
     # we should measure start up with the start up cache populated. We wait to ensure the cache is
-    # populated during the warm up run. If the args say we shouldn't wait, we only wait a short
-    # duration that is roughly visual completeness.
+    # populated during the warm up run: this is the upper bound and we stop waiting once the cache
+    # write is logged. If the args say we shouldn't wait, we only wait a short duration that is
+    # roughly visual completeness.
     return 5 if no_startup_cache else 60
 
 
@@ -305,11 +628,38 @@ def main():
     validate_args(args)
 
     pkg_id = PROD_TO_CHANNEL_TO_PKGID[args.product][args.release_channel]
-    start_cmd = get_start_cmd(args.test_name, pkg_id, args.product)
-    print_preface_text(args.test_name)
-    measurements = measure(args.test_name, args.product, pkg_id, start_cmd, args.iter_count,
-                           get_warmup_delay_seconds(args.no_startup_cache))
-    save_measurements(args.path, measurements)
+
+    iter_count = args.iter_count
+    is_precise_enough = None
+    if args.adaptive:
+        iter_count = args.max_iter_count
+        is_precise_enough = functools.partial(is_median_precise_enough, min_iter_count=args.min_iter_count,
+                                              target_ci_width_percent=args.target_ci_width)
+
+    previous_measurements = []
+    if args.resume and os.path.exists(args.path):
+        previous_measurements = [record[analyze_durations.MEASUREMENT_RECORD_KEY_DURATION]
+                                 for record in read_measurement_records_to_resume(args.path)]
+        if len(previous_measurements) >= iter_count or (is_precise_enough and
+                                                        is_precise_enough(previous_measurements)):
+            print('All iterations were already completed in {}: nothing to resume.'.format(args.path))
+            return
+        print('Resuming after the {} iterations completed in {}.'.format(len(previous_measurements), args.path))
+    else:
+        create_measurement_records_file(args.path)
+
+    with AdbShell(args.serial) as shell:
+        start_cmd = get_start_cmd(shell, args.test_name, pkg_id, args.product, args.component)
+        print_preface_text(args.test_name)
+        measure(shell, args.test_name, args.product, pkg_id, start_cmd, iter_count,
+                get_warmup_delay_seconds(args.no_startup_cache), args.logcat_timeout,
+                is_precise_enough, wait_for_startup_cache=not args.no_startup_cache,
+                on_measurement=functools.partial(append_measurement_record, args.path),
+                previous_measurements=previous_measurements, cool_down_temp_c=args.cool_down_temp,
+                cool_down_timeout_seconds=args.cool_down_timeout)
+
+    if args.print_adb_timings:
+        shell.print_timings()
 
 
 if __name__ == '__main__':
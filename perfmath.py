@@ -3,9 +3,39 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+from collections import namedtuple
 from datetime import datetime
+import math
 import statistics
 
+import numpy as np
+
+Z_95 = 1.96  # The z-score for a two-sided 95% confidence interval.
+
+DEFAULT_CONFIDENCE = 0.95
+DEFAULT_RESAMPLE_COUNT = 10000
+
+# The seed is fixed so analyzing the same replicates always gives the same intervals.
+DEFAULT_SEED = 0
+
+# Resamples are drawn in chunks of about this many values to bound memory on large replicate sets.
+BOOTSTRAP_CHUNK_VALUE_COUNT = 1000000
+
+# Samples with a modified z-score above this are outliers, as recommended by Iglewicz and Hoaglin.
+MAD_OUTLIER_THRESHOLD = 3.5
+
+# Samples further than this many IQRs outside the quartiles are outliers, i.e. Tukey's fences.
+IQR_OUTLIER_FENCE = 1.5
+
+# The warm-up is assumed to be at most this fraction of the samples, as is conventional for MSER.
+MAX_WARM_UP_FRACTION = 0.5
+
+# A warm-up is only trimmed if it differs from the remaining samples at this significance level. Several prefixes are
+# tested so this is stricter than the conventional 0.05 to keep trimming stationary series rare.
+WARM_UP_SIGNIFICANCE_LEVEL = 0.02
+
+MannWhitneyResult = namedtuple('MannWhitneyResult', ['u', 'p_value'])
+
 
 def percent_change(old, new):
     # Ensure we're not using truncating integers.
@@ -27,6 +57,268 @@ def percent_difference(v1, v2):
     return abs(numerator / denominator) * 100
 
 
+def median_confidence_interval(values, z=Z_95):
+    """Returns the (low, high) bounds of the confidence interval of the median of the given values.
+
+    This is distribution-free: the bounds are the order statistics whose ranks are given by the
+    normal approximation to the binomial distribution, rounded to the nearest rank. See
+    https://www-users.york.ac.uk/~mb55/intro/cicent.htm
+    """
+    sorted_values = sorted(values)
+    n = len(sorted_values)
+    offset = z * math.sqrt(n) / 2
+
+    # These ranks are 1-indexed.
+    low_rank = max(round(n / 2 - offset), 1)
+    high_rank = min(round(1 + n / 2 + offset), n)
+    return sorted_values[low_rank - 1], sorted_values[high_rank - 1]
+
+
+def bootstrap_medians(values, resample_count=DEFAULT_RESAMPLE_COUNT, rng=None):
+    """Returns the medians of resample_count resamples, drawn with replacement, of the given values."""
+    if rng is None:
+        rng = np.random.default_rng(DEFAULT_SEED)
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    chunk_size = max(BOOTSTRAP_CHUNK_VALUE_COUNT // n, 1)
+
+    medians = np.empty(resample_count)
+    for start in range(0, resample_count, chunk_size):
+        end = min(start + chunk_size, resample_count)
+        indices = rng.integers(0, n, size=(end - start, n))
+        medians[start:end] = np.median(values[indices], axis=1)
+    return medians
+
+
+def _percentile_interval(estimates, confidence):
+    alpha = (1 - confidence) / 2 * 100
+    low, high = np.percentile(estimates, [alpha, 100 - alpha])
+    return float(low), float(high)
+
+
+def bootstrap_median_ci(values, confidence=DEFAULT_CONFIDENCE, resample_count=DEFAULT_RESAMPLE_COUNT,
+                        seed=DEFAULT_SEED):
+    """Returns the (low, high) bounds of the percentile bootstrap confidence interval of the median."""
+    medians = bootstrap_medians(values, resample_count, np.random.default_rng(seed))
+    return _percentile_interval(medians, confidence)
+
+
+def bootstrap_percent_change_ci(old_values, new_values, confidence=DEFAULT_CONFIDENCE,
+                                resample_count=DEFAULT_RESAMPLE_COUNT, seed=DEFAULT_SEED):
+    """Returns the (low, high) bounds of the percentile bootstrap confidence interval of the percent change
+    from the median of old_values to the median of new_values. Each set is resampled independently.
+    """
+    rng = np.random.default_rng(seed)
+    old_medians = bootstrap_medians(old_values, resample_count, rng)
+    new_medians = bootstrap_medians(new_values, resample_count, rng)
+    percent_changes = (new_medians - old_medians) / np.abs(old_medians) * 100  # Same formula as percent_change.
+    return _percentile_interval(percent_changes, confidence)
+
+
+def rank_with_ties(values):
+    """Returns the 1-indexed ranks of the given values, giving tied values the average of their ranks, and the
+    size of each group of ties.
+    """
+    unique_values, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    # The tied values occupy the ranks after all smaller values so their average rank is the middle of that run.
+    upper_ranks = np.cumsum(counts)
+    average_ranks = upper_ranks - (counts - 1) / 2
+    return average_ranks[inverse], counts
+
+
+def mann_whitney_u(x, y):
+    """Returns the Mann-Whitney U statistic of x and the two-sided p-value of the hypothesis that x and y come
+    from the same distribution.
+
+    The p-value uses the normal approximation with tie and continuity corrections, like
+    scipy.stats.mannwhitneyu(x, y, method='asymptotic'), which is accurate enough for our replicate counts
+    (20+ per set). See https://en.wikipedia.org/wiki/Mann%E2%80%93Whitney_U_test#Normal_approximation_and_tie_correction
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n1 = len(x)
+    n2 = len(y)
+    n = n1 + n2
+
+    ranks, tie_counts = rank_with_ties(np.concatenate([x, y]))
+    u = float(ranks[:n1].sum() - n1 * (n1 + 1) / 2)
+
+    mean_u = n1 * n2 / 2
+    tie_correction = (tie_counts ** 3 - tie_counts).sum() / (n * (n - 1))
+    stdev_u = math.sqrt(n1 * n2 / 12 * ((n + 1) - tie_correction))
+    if stdev_u == 0:
+        return MannWhitneyResult(u, 1.0)  # Every value is the same.
+
+    z = max(abs(u - mean_u) - 0.5, 0) / stdev_u
+    p_value = math.erfc(z / math.sqrt(2))
+    return MannWhitneyResult(u, p_value)
+
+
+def get_mad_outlier_mask(values, threshold=MAD_OUTLIER_THRESHOLD):
+    """Returns a boolean array that is True for the outliers in the given values, according to the modified z-score
+    computed from the median absolute deviation (MAD). If more than half the values are equal, the MAD is 0 and no
+    value is considered an outlier.
+    """
+    values = np.asarray(values, dtype=float)
+    median = np.median(values)
+    mad = np.median(np.abs(values - median))
+    if mad == 0:
+        return np.zeros(len(values), dtype=bool)
+    # 0.6745 is the 75th percentile of the standard normal distribution so this is consistent with a z-score.
+    return 0.6745 * np.abs(values - median) / mad > threshold
+
+
+def get_iqr_outlier_mask(values, fence=IQR_OUTLIER_FENCE):
+    """Returns a boolean array that is True for the values outside of Tukey's fences."""
+    values = np.asarray(values, dtype=float)
+    q1, q3 = np.percentile(values, [25, 75])
+    iqr = q3 - q1
+    return (values < q1 - fence * iqr) | (values > q3 + fence * iqr)
+
+
+def get_warm_up_count(values, max_fraction=MAX_WARM_UP_FRACTION, significance_level=WARM_UP_SIGNIFICANCE_LEVEL):
+    """Returns the number of values at the start of the series that are part of an initial transient, e.g. the
+    first runs after an install, using the Marginal Standard Error Rule (MSER): the warm-up is the prefix whose
+    removal minimizes the standard error of the mean of the remaining values.
+    See https://doi.org/10.1177/003754979706900601
+
+    On stationary series, MSER often finds a warm-up by chance so we only consider prefixes that the Mann-Whitney U
+    test says differ from the remaining values and return the one with the lowest MSER, or 0 if there are none. The
+    unrestricted minimum is often a long prefix that isn't significant even when a short transient is.
+    """
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+
+    # The sum and sum of squares of values[d:] for every truncation point d, computed in one pass.
+    suffix_sums = np.cumsum(values[::-1])[::-1]
+    suffix_square_sums = np.cumsum(values[::-1] ** 2)[::-1]
+    counts = np.arange(n, 0, -1)
+    squared_errors = np.maximum(suffix_square_sums - suffix_sums ** 2 / counts, 0)
+    mser = squared_errors / counts ** 2
+
+    warm_up_count = 0
+    for count in range(1, int(n * max_fraction) + 1):
+        # The test is the expensive part so it's only run for prefixes that would improve on the best so far.
+        if mser[count] < mser[warm_up_count] and \
+                mann_whitney_u(values[:count], values[count:]).p_value < significance_level:
+            warm_up_count = count
+    return warm_up_count
+
+
+class RunningStats:
+    """Computes the count, mean, sample variance, min, and max of a stream of values in constant memory using
+    Welford's algorithm, which, unlike summing squares, is numerically stable.
+    See https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Welford's_online_algorithm
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.min = None
+        self.max = None
+        self._squared_distance_sum = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._squared_distance_sum += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    @property
+    def variance(self):
+        """The sample variance, like statistics.variance, or None if there are fewer than two values."""
+        return self._squared_distance_sum / (self.count - 1) if self.count > 1 else None
+
+    @property
+    def stdev(self):
+        variance = self.variance
+        return math.sqrt(variance) if variance is not None else None
+
+
+class P2Quantile:
+    """Estimates a quantile of a stream of values in constant memory using the P-squared algorithm, which
+    tracks five markers whose heights approximate the min, the quantile, the max, and the quantiles halfway
+    between them. See Jain and Chlamtac, https://doi.org/10.1145/4372.4378
+
+    Until five values are added, the exact quantile is returned.
+    """
+
+    MARKER_COUNT = 5
+
+    def __init__(self, quantile):
+        assert 0 <= quantile <= 1, 'quantile must be in [0, 1]: {}'.format(quantile)
+        self.quantile = quantile
+        self._heights = []
+        p = quantile
+        # The marker positions are 1-indexed, like the paper.
+        self._positions = [1, 2, 3, 4, 5]
+        self._desired_positions = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self._desired_position_increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, value):
+        heights = self._heights
+        if len(heights) < self.MARKER_COUNT:
+            heights.append(value)
+            heights.sort()
+            return
+
+        # Find the cell the value falls in, extending the extreme markers if needed.
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[-1]:
+            heights[-1] = value
+            cell = self.MARKER_COUNT - 2
+        else:
+            cell = next(i for i in range(self.MARKER_COUNT - 1) if heights[i] <= value < heights[i + 1])
+
+        positions = self._positions
+        for i in range(cell + 1, self.MARKER_COUNT):
+            positions[i] += 1
+        for i in range(self.MARKER_COUNT):
+            self._desired_positions[i] += self._desired_position_increments[i]
+
+        # Move the middle markers towards their desired positions.
+        for i in range(1, self.MARKER_COUNT - 1):
+            offset = self._desired_positions[i] - positions[i]
+            if (offset >= 1 and positions[i + 1] - positions[i] > 1) or \
+                    (offset <= -1 and positions[i - 1] - positions[i] < -1):
+                direction = 1 if offset > 0 else -1
+                height = self._parabolic_height(i, direction)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self._linear_height(i, direction)
+                heights[i] = height
+                positions[i] += direction
+
+    def _parabolic_height(self, i, d):
+        q = self._heights
+        n = self._positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def _linear_height(self, i, d):
+        q = self._heights
+        n = self._positions
+        return q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+
+    @property
+    def value(self):
+        """The estimated quantile, or None if no values were added."""
+        heights = self._heights
+        if not heights:
+            return None
+        if len(heights) < self.MARKER_COUNT or self._positions[-1] == self.MARKER_COUNT:
+            # We have all the values so we interpolate between them like numpy.percentile.
+            position = (len(heights) - 1) * self.quantile
+            lower = math.floor(position)
+            upper = math.ceil(position)
+            return heights[lower] + (heights[upper] - heights[lower]) * (position - lower)
+        return heights[2]
+
+
 def screenrecord_timestamp_diff(start_str, end_str):
     """Measures the difference between two timestamps taken from
     `adb shell screenrecord --bugreport`. Sample timestamp: 14:42:18.291
@@ -46,6 +338,8 @@ $ python3
 -60.0
 >>> perfmath.percent_difference(10, 4)
 85.71428571428571
+>>> perfmath.mann_whitney_u([1, 2, 3, 4, 5], [6, 7, 8, 9, 10])
+MannWhitneyResult(u=0.0, p_value=0.012185780355344818)
 """)
 
 
@@ -2,11 +2,19 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import adb
 import sys
 import argparse
 import subprocess
 import time
 
+# Upper bounds for the readiness probes below: we only wait this long if the condition never holds.
+PROCESS_EXIT_TIMEOUT_SECONDS = 3
+SCREENRECORD_START_TIMEOUT_SECONDS = 3
+SCREENRECORD_EXIT_TIMEOUT_SECONDS = 5
+# The screenrecord process is running shortly before it records frames so we give it this long to settle.
+SCREENRECORD_SETTLE_SECONDS = 1
+
 
 # This script records a video of the phone screen and triggers app activity in one of three ways:
 #  - mode == "touch": Simulates user touch at the specified coordinates
@@ -31,15 +39,21 @@ def main(args):
         print('--mode applink requires --url and --package arguments')
         sys.exit()
 
-    kill_existing_processes("org.mozilla")
-    kill_existing_processes("com.android.chrome")
-    kill_existing_processes("org.chromium.chrome")
-    time.sleep(3)
+    for package_substr in ["org.mozilla", "com.android.chrome", "org.chromium.chrome"]:
+        kill_existing_processes(package_substr)
+        if not adb.wait_for_processes_to_exit(package_substr, PROCESS_EXIT_TIMEOUT_SECONDS):
+            print('WARNING: {} processes were still running after {}s: continuing anyway.'.format(
+                package_substr, PROCESS_EXIT_TIMEOUT_SECONDS), file=sys.stderr)
 
     # Start the recording. screenrecord --bugreport puts timestamps at the top of the video and adds
     # a frame with device information at the beginning.
     record_process = subprocess.Popen(['adb', 'shell', 'screenrecord', '--bugreport'] + [device_path])
-    time.sleep(3)
+    if not adb.poll_until(lambda: adb.is_process_running('screenrecord'), SCREENRECORD_START_TIMEOUT_SECONDS):
+        record_process.kill()
+        print('screenrecord did not start within {}s: aborting.'.format(SCREENRECORD_START_TIMEOUT_SECONDS),
+              file=sys.stderr)
+        sys.exit(1)
+    time.sleep(SCREENRECORD_SETTLE_SECONDS)
 
     if mode == "touch":
         simulate_input(args.coordinate_x, args.coordinate_y)
@@ -65,9 +79,12 @@ def main(args):
             activity = args.package + "/com.google.android.apps.chrome.IntentDispatcher"
         record_with_view_intent(activity, args.url)
 
-    time.sleep(5)
+    time.sleep(5)  # The duration of the recording after the event.
     record_process.kill()
-    time.sleep(5)
+    # screenrecord finishes writing the video before it exits.
+    if not adb.poll_until(lambda: not adb.is_process_running('screenrecord'), SCREENRECORD_EXIT_TIMEOUT_SECONDS):
+        print('WARNING: screenrecord did not exit within {}s: the recording may be truncated.'.format(
+            SCREENRECORD_EXIT_TIMEOUT_SECONDS), file=sys.stderr)
     pull_recording(device_path, args.output)
 
 
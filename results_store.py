@@ -0,0 +1,264 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""An indexed SQLite store of measurement results, e.g. from backfill.py, so tools can query them by date or commit
+range without listing and parsing the result files. It only uses the standard library.
+
+The schema:
+    runs: each invocation that added results.
+    builds: each measured APK, identified by its name, with its date or commit and content hash, if known.
+    tests, devices: the names of the tests and device models.
+    results: the stats of one test on one build and device, from one run, without the replicates.
+    replicates: the duration of each iteration of a result.
+"""
+
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    description TEXT
+);
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY,
+    apk_name TEXT NOT NULL UNIQUE,
+    product TEXT,
+    architecture TEXT,
+    date TEXT,
+    commit_hash TEXT,
+    apk_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS builds_date ON builds (date);
+CREATE INDEX IF NOT EXISTS builds_commit_hash ON builds (commit_hash);
+CREATE INDEX IF NOT EXISTS builds_apk_hash ON builds (apk_hash);
+CREATE TABLE IF NOT EXISTS tests (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS devices (
+    id INTEGER PRIMARY KEY,
+    model TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    build_id INTEGER NOT NULL REFERENCES builds (id),
+    test_id INTEGER NOT NULL REFERENCES tests (id),
+    device_id INTEGER REFERENCES devices (id),
+    median REAL,
+    stats TEXT NOT NULL,
+    source_path TEXT UNIQUE
+);
+CREATE INDEX IF NOT EXISTS results_build_test ON results (build_id, test_id);
+CREATE TABLE IF NOT EXISTS replicates (
+    result_id INTEGER NOT NULL REFERENCES results (id),
+    iteration INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    PRIMARY KEY (result_id, iteration)
+) WITHOUT ROWID;
+"""
+
+KEY_REPLICATES = 'replicates'
+KEY_MEDIAN = 'median'
+
+# The keys added to the stats of each result returned by ResultsStore.get_results.
+KEY_APK_NAME = 'apk_name'
+KEY_DATE = 'date'
+KEY_COMMIT = 'commit'
+KEY_TEST_NAME = 'test_name'
+KEY_DEVICE = 'device'
+KEY_PRODUCT = 'product'
+
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def to_date_str(date):
+    """Returns the given date, datetime or string as a YYYY-MM-DD string, which sorts chronologically."""
+    if hasattr(date, 'strftime'):
+        return date.strftime(DATE_FORMAT)
+    return date
+
+
+class ResultsStore:
+    """The store can be shared between threads, e.g. the workers measuring on several devices: writes are
+    serialized and each result is committed as soon as it's added so an interrupted run loses nothing.
+
+    Usage:
+        with ResultsStore('results.sqlite') as store:
+            run_id = store.start_run()
+            store.add_result(run_id, 'nightly_2021_09_01', 'cold_main_first_frame', stats, date='2021-09-01')
+            results = store.get_results(start_date='2021-09-01', end_date='2021-09-30')
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            # Write-ahead logging lets other processes read while results are written.
+            self._connection.execute('PRAGMA journal_mode = WAL')
+            self._connection.executescript(SCHEMA)
+            self._connection.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+
+    @classmethod
+    def open_scratch_copy(cls, path):
+        """Returns an in-memory store with the contents of the store at path, if it exists, e.g. for a dry run: the
+        changes made to it aren't saved.
+        """
+        store = cls(':memory:')
+        if os.path.exists(path):
+            with contextlib.closing(sqlite3.connect(path)) as source, store._lock:
+                source.backup(store._connection)
+        return store
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def start_run(self, description=None):
+        """Records a new run, e.g. a backfill invocation, and returns its id for add_result."""
+        with self._lock, self._connection:
+            return self._connection.execute('INSERT INTO runs (started_at, description) VALUES (?, ?)',
+                                            (time.time(), description)).lastrowid
+
+    def _get_or_insert_id(self, table, column, value):
+        row = self._connection.execute('SELECT id FROM {} WHERE {} = ?'.format(table, column), (value,)).fetchone()
+        if row:
+            return row[0]
+        return self._connection.execute('INSERT INTO {} ({}) VALUES (?)'.format(table, column), (value,)).lastrowid
+
+    def _get_or_insert_build_id(self, apk_name, product, architecture, date, commit, apk_hash):
+        build_id = self._get_or_insert_id('builds', 'apk_name', apk_name)
+        # The build may have been added with less metadata, e.g. by an import, so we fill in what's known.
+        self._connection.execute(
+            'UPDATE builds SET product = coalesce(?, product), architecture = coalesce(?, architecture), '
+            'date = coalesce(?, date), commit_hash = coalesce(?, commit_hash), apk_hash = coalesce(?, apk_hash) '
+            'WHERE id = ?', (product, architecture, to_date_str(date) if date else None, commit, apk_hash, build_id))
+        return build_id
+
+    def has_result(self, source_path):
+        with self._lock:
+            return self._connection.execute('SELECT 1 FROM results WHERE source_path = ?',
+                                            (source_path,)).fetchone() is not None
+
+    def add_result(self, run_id, apk_name, test_name, stats, device_model=None, product=None, architecture=None,
+                   date=None, commit=None, apk_hash=None, source_path=None):
+        """Adds the stats, e.g. from analyze_durations.analyze_file, of a test on a build. source_path is the
+        file the stats were saved to, if any: a result from the same file is only added once. Returns the
+        result's id or None if it was already added.
+        """
+        stats = dict(stats)
+        replicates = stats.pop(KEY_REPLICATES, [])
+        with self._lock, self._connection:
+            build_id = self._get_or_insert_build_id(apk_name, product, architecture, date, commit or None, apk_hash)
+            test_id = self._get_or_insert_id('tests', 'name', test_name)
+            device_id = self._get_or_insert_id('devices', 'model', device_model) if device_model else None
+            cursor = self._connection.execute(
+                'INSERT INTO results (run_id, build_id, test_id, device_id, median, stats, source_path) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (source_path) DO NOTHING',
+                (run_id, build_id, test_id, device_id, stats.get(KEY_MEDIAN), json.dumps(stats, sort_keys=True),
+                 source_path))
+            if not cursor.rowcount:
+                return None
+
+            result_id = cursor.lastrowid
+            self._connection.executemany('INSERT INTO replicates (result_id, iteration, duration) VALUES (?, ?, ?)',
+                                         ((result_id, i, duration) for i, duration in enumerate(replicates)))
+            return result_id
+
+    def _get_replicates(self, result_id):
+        return [duration for duration, in self._connection.execute(
+            'SELECT duration FROM replicates WHERE result_id = ? ORDER BY iteration', (result_id,))]
+
+    def find_result_by_apk_hash(self, apk_hash, test_name, device_model=None):
+        """Returns the source path and stats, as they were added, of the earliest result of the test on the device
+        for a build with the given content hash, e.g. to reuse it for an identical build, or (None, None).
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT results.id, results.stats, results.source_path FROM results '
+                'JOIN builds ON builds.id = results.build_id '
+                'JOIN tests ON tests.id = results.test_id '
+                'LEFT JOIN devices ON devices.id = results.device_id '
+                'WHERE builds.apk_hash = ? AND tests.name = ? AND devices.model IS ? '
+                'ORDER BY results.id LIMIT 1', (apk_hash, test_name, device_model)).fetchone()
+            if not row:
+                return None, None
+
+            result_id, stats_json, source_path = row
+            stats = json.loads(stats_json)
+            stats[KEY_REPLICATES] = self._get_replicates(result_id)
+            return source_path, stats
+
+    def get_results(self, start_date=None, end_date=None, commits=None, test_name=None, device_model=None,
+                    include_replicates=False):
+        """Returns the stats of each result matching all of the given filters, in chronological order and then in
+        the order of commits, with keys identifying the build, test and device added. The dates are inclusive.
+        Commits are matched by their full hash: the order of a range of commits is only known to git, e.g. see
+        backfill.get_all_commits_in_commits_range.
+        """
+        conditions = []
+        params = []
+        if start_date is not None:
+            conditions.append('builds.date >= ?')
+            params.append(to_date_str(start_date))
+        if end_date is not None:
+            conditions.append('builds.date <= ?')
+            params.append(to_date_str(end_date))
+        if commits is not None:
+            commits = list(commits)
+            conditions.append('builds.commit_hash IN ({})'.format(', '.join('?' * len(commits))))
+            params += commits
+        if test_name is not None:
+            conditions.append('tests.name = ?')
+            params.append(test_name)
+        if device_model is not None:
+            conditions.append('devices.model = ?')
+            params.append(device_model)
+
+        query = ('SELECT results.id, results.stats, builds.apk_name, builds.product, builds.date, '
+                 'builds.commit_hash, tests.name, devices.model FROM results '
+                 'JOIN builds ON builds.id = results.build_id '
+                 'JOIN tests ON tests.id = results.test_id '
+                 'LEFT JOIN devices ON devices.id = results.device_id')
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY builds.date, builds.apk_name, tests.name, results.id'
+
+        results = []
+        with self._lock:
+            for result_id, stats_json, apk_name, product, date, commit, result_test_name, device in \
+                    self._connection.execute(query, params).fetchall():
+                stats = json.loads(stats_json)
+                stats.update({
+                    KEY_APK_NAME: apk_name,
+                    KEY_DATE: date,
+                    KEY_COMMIT: commit,
+                    KEY_TEST_NAME: result_test_name,
+                })
+                if product:
+                    stats[KEY_PRODUCT] = product
+                if device:
+                    stats[KEY_DEVICE] = device
+                if include_replicates:
+                    stats[KEY_REPLICATES] = self._get_replicates(result_id)
+                results.append(stats)
+
+        if commits is not None:
+            commit_to_index = {commit: i for i, commit in enumerate(commits)}
+            results.sort(key=lambda result: commit_to_index[result[KEY_COMMIT]])  # The sort is stable.
+        return results
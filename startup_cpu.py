@@ -2,18 +2,24 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import adb
 import argparse
 import subprocess
+import sys
 import time
 import re
 
+# The upper bound on how long we wait for killed processes to exit.
+PROCESS_EXIT_TIMEOUT_SECONDS = 3
+
 
 def main(args):
-    kill_existing_processes("org.mozilla")
-    kill_existing_processes("com.android.chrome")
-    kill_existing_processes("org.chromium.chrome")
-    print("Waiting for three seconds.")
-    time.sleep(3)
+    print("Waiting for existing processes to exit.")
+    for package_substr in ["org.mozilla", "com.android.chrome", "org.chromium.chrome"]:
+        kill_existing_processes(package_substr)
+        if not adb.wait_for_processes_to_exit(package_substr, PROCESS_EXIT_TIMEOUT_SECONDS):
+            print('WARNING: {} processes were still running after {}s: continuing anyway.'.format(
+                package_substr, PROCESS_EXIT_TIMEOUT_SECONDS), file=sys.stderr)
 
     print("Launching app.")
 
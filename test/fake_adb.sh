@@ -0,0 +1,35 @@
+#!/bin/sh
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# A fake adb for developing and testing without a device: `adb [-s SERIAL] shell [COMMAND...]` runs the command, or
+# the commands on stdin, with the local sh. Other adb commands aren't supported.
+#
+# Set FAKE_ADB_MERGE_STDERR=1 to emulate devices without the shell protocol v2, on which adb merges stderr into stdout
+# and doesn't return the command's exit code.
+#
+# Usage: ADB=test/fake_adb.sh ./measure_start_up.py ...
+
+if [ "$1" = "-s" ]; then
+    shift 2
+fi
+if [ "$1" != "shell" ]; then
+    echo "fake adb: unsupported command: $*" >&2
+    exit 1
+fi
+shift
+
+if [ -n "$FAKE_ADB_MERGE_STDERR" ]; then
+    exec 2>&1
+    if [ $# -eq 0 ]; then
+        exec sh
+    fi
+    sh -c "$*"
+    exit 0
+fi
+
+if [ $# -eq 0 ]; then
+    exec sh
+fi
+exec sh -c "$*"
@@ -0,0 +1,64 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Tests AdbShell against fake_adb.sh, which runs the commands locally. Run from the repository root with
+`python3 -m unittest discover -s test`.
+"""
+
+import os
+import subprocess
+import time
+import unittest
+from unittest import mock
+
+import adb
+
+FAKE_ADB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_adb.sh')
+
+
+class AdbShellTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(adb, 'ADB_EXECUTABLE', FAKE_ADB_PATH)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start_shell(self):
+        shell = adb.AdbShell()
+        shell.start()
+        self.addCleanup(shell.close)
+        return shell
+
+    def test_separates_stdout_stderr_and_exit_code(self):
+        shell = self.start_shell()
+        proc = shell.run(['sh', '-c', 'echo out; echo err >&2; exit 3'])
+        self.assertEqual((proc.stdout, proc.stderr, proc.returncode), (b'out\n', b'err\n', 3))
+        with self.assertRaises(subprocess.CalledProcessError):
+            shell.run(['false'], check=True)
+
+    def test_output_without_trailing_newline(self):
+        shell = self.start_shell()
+        self.assertEqual(shell.run(['printf', 'no newline']).stdout, b'no newline')
+
+    def test_timeout_is_recorded_and_does_not_delay_the_next_command(self):
+        shell = self.start_shell()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            shell.run(['sleep', '3'], timeout=0.5)
+        self.assertEqual(shell.timings[-1].returncode, None)
+
+        start = time.monotonic()
+        proc = shell.run(['echo', 'after'])
+        self.assertEqual((proc.stdout, proc.returncode), (b'after\n', 0))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertLess(shell.timings[-1].seconds, 1)
+
+    def test_falls_back_to_one_shell_per_command_if_stderr_is_merged(self):
+        with mock.patch.dict(os.environ, {'FAKE_ADB_MERGE_STDERR': '1'}):
+            shell = self.start_shell()
+            proc = shell.run(['sh', '-c', 'echo out; echo err >&2; exit 3'], timeout=5)
+        self.assertEqual((proc.stdout, proc.returncode), (b'out\nerr\n', 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Run from the repository root with `python3 -m unittest discover -s test`."""
+
+import unittest
+
+import numpy as np
+
+import perfmath
+
+TRIAL_COUNT = 200
+
+
+class GetWarmUpCountTest(unittest.TestCase):
+
+    def test_removes_short_cold_transient(self):
+        rng = np.random.default_rng(0)
+        for trial in range(TRIAL_COUNT):
+            values = rng.normal(1000, 30, 30)
+            values[:3] *= 1.5  # e.g. the first cold starts after an install.
+            self.assertGreaterEqual(perfmath.get_warm_up_count(values), 3, 'trial {}'.format(trial))
+
+    def test_rarely_trims_stationary_series(self):
+        rng = np.random.default_rng(0)
+        trimmed_count = sum(perfmath.get_warm_up_count(rng.normal(1000, 30, 30)) > 0 for _ in range(TRIAL_COUNT))
+        self.assertLess(trimmed_count / TRIAL_COUNT, 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Samples the device's thermal state from sysfs so measurements can wait for the device
+to cool down and throttled measurements can be identified.
+"""
+
+import time
+
+DEFAULT_COOL_DOWN_TIMEOUT_SECONDS = 120
+COOL_DOWN_POLL_INTERVAL_SECONDS = 2
+
+# Some thermal zones report nonsensical values, e.g. when a sensor is disabled, so we ignore them.
+PLAUSIBLE_TEMP_RANGE_C = (0, 150)
+
+# Prints one line per thermal zone and per CPU so everything is sampled in a single round trip:
+#   zone <type> <temp>
+#   cpu <path> <scaling_cur_freq> <scaling_max_freq>
+SAMPLE_SCRIPT = """
+for zone in /sys/class/thermal/thermal_zone*; do
+    echo "zone $(cat $zone/type 2>/dev/null) $(cat $zone/temp 2>/dev/null)"
+done
+for cpu in /sys/devices/system/cpu/cpu[0-9]*/cpufreq; do
+    echo "cpu $cpu $(cat $cpu/scaling_cur_freq 2>/dev/null) $(cat $cpu/scaling_max_freq 2>/dev/null)"
+done
+"""
+
+KEY_MAX_TEMP_C = 'max_temp_c'
+KEY_CPU_FREQ_KHZ = 'cpu_freq_khz'
+KEY_CPU_MAX_FREQ_KHZ = 'cpu_max_freq_khz'
+KEY_IS_THROTTLED = 'is_throttled'
+
+
+def parse_temp_c(value):
+    """Most devices report millidegrees Celsius but some report degrees."""
+    temp = float(value)
+    return temp / 1000 if abs(temp) >= 1000 else temp
+
+
+def get_cpu_name(cpufreq_path):
+    """e.g. /sys/devices/system/cpu/cpu4/cpufreq -> cpu4."""
+    return cpufreq_path.rstrip('/').split('/')[-2]
+
+
+def parse_thermal_sample(output, baseline_max_freqs_khz=None):
+    """Many devices permanently limit the maximum frequency of some CPUs, e.g. the little cores, so the CPUs are
+    only considered throttled if their maximum frequency is lower than in baseline_max_freqs_khz: the
+    KEY_CPU_MAX_FREQ_KHZ of a sample taken at the start of the run. Without a baseline, only the temperature is known.
+    """
+    temps_c = []
+    cpu_freqs_khz = []
+    cpu_max_freqs_khz = {}
+    for line in output.splitlines():
+        columns = line.split()
+        try:
+            if len(columns) == 3 and columns[0] == 'zone':
+                temp_c = parse_temp_c(columns[2])
+                if PLAUSIBLE_TEMP_RANGE_C[0] < temp_c < PLAUSIBLE_TEMP_RANGE_C[1]:
+                    temps_c.append(temp_c)
+            elif len(columns) == 4 and columns[0] == 'cpu':
+                cur_freq, scaling_max_freq = [int(c) for c in columns[2:]]
+                cpu_freqs_khz.append(cur_freq)
+                cpu_max_freqs_khz[get_cpu_name(columns[1])] = scaling_max_freq
+        except ValueError:
+            continue  # The file couldn't be read, e.g. because the CPU is offline.
+
+    # The governor lowers the maximum frequency when the device is throttled.
+    is_freq_capped = bool(baseline_max_freqs_khz) and any(
+        max_freq < baseline_max_freqs_khz.get(cpu, max_freq) for cpu, max_freq in cpu_max_freqs_khz.items())
+    return {
+        KEY_MAX_TEMP_C: max(temps_c) if temps_c else None,
+        KEY_CPU_FREQ_KHZ: cpu_freqs_khz,
+        KEY_CPU_MAX_FREQ_KHZ: cpu_max_freqs_khz,
+        KEY_IS_THROTTLED: is_freq_capped,
+    }
+
+
+def sample_thermal_state(shell, baseline_max_freqs_khz=None):
+    """Returns the hottest thermal zone, the current and maximum frequency of each CPU, and whether the CPU
+    frequency is limited compared to the baseline, as a JSON-serializable dict: see parse_thermal_sample.
+    """
+    proc = shell.run(['sh', '-c', SAMPLE_SCRIPT])
+    return parse_thermal_sample(proc.stdout.decode('utf-8', errors='replace'), baseline_max_freqs_khz)
+
+
+def wait_for_cool_down(shell, max_temp_c, timeout_seconds=DEFAULT_COOL_DOWN_TIMEOUT_SECONDS,
+                       baseline_max_freqs_khz=None):
+    """Waits until the hottest thermal zone is at most max_temp_c and the CPU frequency isn't limited compared to
+    the baseline, or timeout_seconds elapse. Returns the last thermal state sampled.
+    """
+    deadline = time.monotonic() + timeout_seconds
+    state = sample_thermal_state(shell, baseline_max_freqs_khz)
+    start = time.monotonic()
+    while is_too_hot(state, max_temp_c) and time.monotonic() < deadline:
+        time.sleep(COOL_DOWN_POLL_INTERVAL_SECONDS)
+        state = sample_thermal_state(shell, baseline_max_freqs_khz)
+
+    waited_seconds = time.monotonic() - start
+    if is_too_hot(state, max_temp_c):
+        print('WARNING: the device did not cool down to {}C within {}s: continuing at {}C.'.format(
+            max_temp_c, timeout_seconds, state[KEY_MAX_TEMP_C]))
+    elif waited_seconds > 0.5:
+        print('Waited {:.0f}s for the device to cool down to {}C.'.format(waited_seconds, max_temp_c))
+    return state
+
+
+def is_too_hot(state, max_temp_c):
+    temp_c = state[KEY_MAX_TEMP_C]
+    return state[KEY_IS_THROTTLED] or (temp_c is not None and temp_c > max_temp_c)
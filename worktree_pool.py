@@ -0,0 +1,93 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""A pool of `git worktree`s of a repository so several commits can be checked out and built concurrently
+without touching the user's checkout.
+
+The worktrees are kept across runs so each one reuses its incremental build state, e.g. Gradle's build
+directories, when it's used to build the next commit.
+"""
+
+import contextlib
+import hashlib
+import os
+import queue
+import shutil
+import subprocess
+import threading
+
+import fileutil
+
+DEFAULT_WORKTREES_DIR = os.path.join(fileutil.CACHE_DIR, 'worktrees')
+
+# Untracked files that builds need, e.g. local.properties points Gradle at the Android SDK.
+COPIED_UNTRACKED_FILES = ['local.properties']
+
+
+def get_repository_key(repository_path):
+    """Worktrees are created in a directory per repository so pools of different repositories don't collide."""
+    return hashlib.sha256(os.path.realpath(repository_path).encode('utf-8')).hexdigest()[:16]
+
+
+def run_checked(args, cwd):
+    proc = subprocess.run(args, cwd=cwd, capture_output=True)
+    if proc.returncode != 0:
+        raise Exception('`{}` failed in {}:\n\n{}'.format(
+            ' '.join(args), cwd, proc.stderr.decode('utf-8').strip('\n')))
+    return proc
+
+
+class WorktreePool:
+    """Hands out up to size worktrees of the repository, one per concurrent user. Worktrees are created the first
+    time they're needed and are left detached at whatever their last user checked out. If clean_args is given,
+    e.g. ['./gradlew', 'clean'], it's run in each worktree the first time it's handed out by this pool, to discard
+    build state from earlier runs.
+
+    Usage:
+        pool = WorktreePool('../fenix', 2)
+        with pool.acquire() as worktree_path:
+            build(commit, worktree_path)
+    """
+
+    def __init__(self, repository_path, size, worktrees_dir=DEFAULT_WORKTREES_DIR, clean_args=None):
+        self.repository_path = os.path.abspath(repository_path)
+        self.size = size
+        self.clean_args = clean_args
+        self._cleaned_paths = set()
+        self._dir = os.path.join(os.path.abspath(worktrees_dir), get_repository_key(repository_path))
+        self._available = queue.Queue()
+        for index in range(size):
+            self._available.put(os.path.join(self._dir, str(index)))
+        # `git worktree` updates the repository's metadata so it mustn't be run concurrently.
+        self._git_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def acquire(self):
+        """Waits until a worktree is free and yields its path."""
+        worktree_path = self._available.get()
+        try:
+            self._prepare(worktree_path)
+            yield worktree_path
+        finally:
+            self._available.put(worktree_path)
+
+    def _prepare(self, worktree_path):
+        if not os.path.exists(os.path.join(worktree_path, '.git')):
+            with self._git_lock:
+                # The worktree may have been deleted without git knowing, or only partially created.
+                run_checked(['git', 'worktree', 'prune'], self.repository_path)
+                shutil.rmtree(worktree_path, ignore_errors=True)
+                os.makedirs(self._dir, exist_ok=True)
+                run_checked(['git', 'worktree', 'add', '--detach', worktree_path], self.repository_path)
+
+        # We copy these each time so changes in the user's checkout, e.g. a new SDK path, are picked up.
+        for filename in COPIED_UNTRACKED_FILES:
+            src_path = os.path.join(self.repository_path, filename)
+            if os.path.exists(src_path):
+                shutil.copyfile(src_path, os.path.join(worktree_path, filename))
+
+        # A worktree is only prepared by its current user, and adding to a set is atomic, so this needs no lock.
+        if self.clean_args and worktree_path not in self._cleaned_paths:
+            run_checked(self.clean_args, worktree_path)
+            self._cleaned_paths.add(worktree_path)